@@ -0,0 +1,110 @@
+"""Burst benchmark for the SQLite access layer.
+
+Simulates a burst of /start + /send updates (track user, rate-limit check,
+message log insert) and reports updates/sec for the old connect-per-call
+pattern running on the event loop vs. the shared WAL connections on the DB
+worker pool.
+
+    python benchmarks/bench_db.py [updates] [concurrency]
+"""
+import os
+import sys
+import time
+import sqlite3
+import asyncio
+import tempfile
+from datetime import datetime, timedelta
+
+TMP_DIR = tempfile.mkdtemp(prefix='ngl_bench_')
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ['DB_PATH'] = os.path.join(TMP_DIR, 'after.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+BEFORE_DB = os.path.join(TMP_DIR, 'before.db')
+
+
+# Connect-per-call implementation as it was before the shared connection layer
+def before_init():
+    conn = sqlite3.connect(BEFORE_DB)
+    conn.execute('CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, username TEXT, message_count INTEGER DEFAULT 0, last_reset TIMESTAMP DEFAULT CURRENT_TIMESTAMP)')
+    conn.execute('CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, ngl_link TEXT, message_text TEXT, status TEXT, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)')
+    conn.execute('CREATE TABLE IF NOT EXISTS bot_users (user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)')
+    conn.commit()
+    conn.close()
+
+
+def before_track_bot_user(user_id, username, first_name):
+    conn = sqlite3.connect(BEFORE_DB)
+    conn.execute('INSERT OR REPLACE INTO bot_users (user_id, username, first_name) VALUES (?, ?, ?)', (user_id, username, first_name))
+    conn.commit()
+    conn.close()
+
+
+def before_check_rate_limit(user_id):
+    conn = sqlite3.connect(BEFORE_DB)
+    cursor = conn.cursor()
+    cursor.execute('SELECT last_reset, message_count FROM users WHERE user_id = ?', (user_id,))
+    result = cursor.fetchone()
+    if result:
+        last_reset = datetime.fromisoformat(result[0])
+        if main.get_current_time() - last_reset > timedelta(hours=24):
+            cursor.execute('UPDATE users SET message_count = 0, last_reset = ? WHERE user_id = ?', (main.get_current_time(), user_id))
+            conn.commit()
+    else:
+        cursor.execute('INSERT INTO users (user_id, message_count, last_reset) VALUES (?, ?, ?)', (user_id, 0, main.get_current_time()))
+        conn.commit()
+    conn.close()
+
+
+def before_track_message(user_id, ngl_link, message_text, status):
+    conn = sqlite3.connect(BEFORE_DB)
+    conn.execute('INSERT INTO messages (user_id, ngl_link, message_text, status) VALUES (?, ?, ?, ?)', (user_id, ngl_link, message_text, status))
+    conn.commit()
+    conn.close()
+
+
+async def before_update(user_id):
+    before_track_bot_user(user_id, f'user{user_id}', 'Bench')
+    before_check_rate_limit(user_id)
+    before_track_message(user_id, 'https://ngl.link/bench', 'hello', 'success')
+
+
+async def after_update(user_id):
+    await main.run_db(main.track_bot_user, user_id, f'user{user_id}', 'Bench')
+    await main.rate_limiter.get_count(user_id)
+    main.track_message(user_id, 'https://ngl.link/bench', 'hello', 'success')
+
+
+async def run_burst(handler, updates, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            await handler(i % 5000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(updates)))
+    # Buffered writes count towards the run
+    await main.run_db(main.flush_message_log)
+    await main.rate_limiter.flush()
+    return updates / (time.perf_counter() - start)
+
+
+async def bench(updates, concurrency):
+    before_init()
+    main.init_db()
+    before = await run_burst(before_update, updates, concurrency)
+    after = await run_burst(after_update, updates, concurrency)
+    print(f"updates={updates} concurrency={concurrency}")
+    print(f"before (connect-per-call): {before:10.1f} updates/sec")
+    print(f"after  (shared WAL pool):  {after:10.1f} updates/sec")
+    print(f"speedup: {after / before:.2f}x")
+
+
+if __name__ == '__main__':
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    asyncio.run(bench(updates, concurrency))
+    main.close_db()
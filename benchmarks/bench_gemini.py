@@ -0,0 +1,109 @@
+"""Gemini generation latency and event-loop responsiveness, offline.
+
+Fires concurrent generations against benchmarks/fake_gemini.py and compares
+the old blocking requests.post call with the async pooled client, called
+directly (no coalescing window, no offline fallback, so errors are counted
+rather than hidden). A separate row goes through the per-language request
+coalescer. While the generations run, a ticker measures how late the event
+loop wakes up - that lag is what every other user's updates wait on.
+
+    python benchmarks/bench_gemini.py [requests] [latency] [error_rate]
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import requests
+
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ.setdefault('GEMINI_API_KEY', 'bench')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_gemini import FakeGeminiServer  # noqa: E402
+
+
+# The blocking implementation generate_gemini_message used before the async client
+def blocking_generate(url, language, count):
+    payload = {"contents": [{"parts": [{"text": f"Generate short, fun anonymous messages in {language} only. Generate {count} different messages."}]}]}
+    try:
+        response = requests.post(f"{url}?key=bench", json=payload, timeout=10)
+        if response.status_code == 200:
+            text = response.json()['candidates'][0]['content']['parts'][0]['text']
+            return [line for line in text.split('\n') if line.strip()][:count]
+        return [f"Fun message #{random.randint(1000,9999)}" for _ in range(count)]
+    except Exception:
+        return [f"Random message {random.randint(1000,9999)}" for _ in range(count)]
+
+
+async def measure(make_call, total):
+    lags = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - start - 0.01)
+
+    tick_task = asyncio.create_task(ticker())
+    latencies = []
+    errors = 0
+
+    async def one():
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            await make_call()
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await tick_task
+    latencies.sort()
+    return elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99) - 1], max(lags or [0]), errors
+
+
+async def bench(total, latency, error_rate):
+    server = FakeGeminiServer(latency=latency, error_rate=error_rate).start()
+    os.environ['GEMINI_API_URL'] = server.url
+    import main
+
+    async def old_call():
+        blocking_generate(server.url, 'English', 5)
+
+    async def new_call():
+        await main.fetch_gemini_messages('english', 5)
+
+    async def coalesced_call():
+        await main.gemini_coalescer.request('english', 5)
+
+    print(f"requests={total} server_latency={latency}s error_rate={error_rate}")
+    for name, call in (("blocking requests.post", old_call), ("async pooled client", new_call),
+                       ("async client, coalesced", coalesced_call)):
+        try:
+            await call()  # warm-up (TLS context, connection pool)
+        except Exception:
+            pass
+        server.max_in_flight = 0
+        requests_before = main.gemini_client.requests
+        retries_before = main.gemini_client.retries
+        elapsed, p50, p99, lag, errors = await measure(call, total)
+        upstream = (f" upstream={main.gemini_client.requests - requests_before}"
+                    f" retries={main.gemini_client.retries - retries_before}") if call is not old_call else ""
+        print(f"{name:24} total={elapsed:6.2f}s p50={p50:6.3f}s p99={p99:6.3f}s "
+              f"max_loop_lag={lag * 1000:8.1f}ms max_concurrency={server.max_in_flight} errors={errors}{upstream}")
+    await main.gemini_client.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.3
+    error_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    asyncio.run(bench(total, latency, error_rate))
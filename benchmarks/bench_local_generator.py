@@ -0,0 +1,64 @@
+"""Local message generator vs. the Gemini path (stubbed), per language.
+
+Reports per-request latency, throughput and how many distinct messages each
+path produces. The Gemini side talks to benchmarks/fake_gemini.py, so the
+numbers show the network/round-trip cost rather than real model time.
+
+    python benchmarks/bench_local_generator.py [batches] [count] [gemini_latency]
+"""
+import os
+import sys
+import time
+import asyncio
+
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ.setdefault('GEMINI_API_KEY', 'bench')
+os.environ['AI_MODE'] = 'gemini'
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_gemini import FakeGeminiServer  # noqa: E402
+
+
+def bench_local(main, language, batches, count):
+    produced = []
+    start = time.perf_counter()
+    for _ in range(batches):
+        produced.extend(main.local_generator.generate(language, count))
+    elapsed = time.perf_counter() - start
+    return elapsed, produced
+
+
+async def bench_gemini(main, language, batches, count):
+    produced = []
+    start = time.perf_counter()
+    for _ in range(batches):
+        produced.extend(await main.fetch_gemini_messages(language, count))
+    elapsed = time.perf_counter() - start
+    return elapsed, produced
+
+
+async def bench(batches, count, latency):
+    server = FakeGeminiServer(latency=latency).start()
+    os.environ['GEMINI_API_URL'] = server.url
+    import main
+
+    print(f"batches={batches} count={count} fake_gemini_latency={latency}s")
+    print(f"{'language':10} {'path':7} {'per batch':>12} {'msgs/ms':>10} {'distinct':>14}")
+    for language in main.LANGUAGES:
+        local_elapsed, local_msgs = bench_local(main, language, batches * 100, count)
+        gemini_elapsed, gemini_msgs = await bench_gemini(main, language, batches, count)
+        for path, elapsed, msgs, runs in (("local", local_elapsed, local_msgs, batches * 100),
+                                          ("gemini", gemini_elapsed, gemini_msgs, batches)):
+            print(f"{language:10} {path:7} {elapsed / runs * 1000:10.4f}ms "
+                  f"{len(msgs) / (elapsed * 1000):10.1f} "
+                  f"{len(set(msgs)):6}/{len(msgs):<7}")
+    await main.gemini_client.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    batches = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.2
+    asyncio.run(bench(batches, count, latency))
@@ -0,0 +1,157 @@
+"""Conversation dispatch cost and memory per session, old flags vs. Session.
+
+Builds N synthetic users part-way through the /send flow and compares the
+old per-user context.user_data dict + if/elif chains with the __slots__
+Session object + table-driven dispatch. Only container/dispatch overhead is
+measured - field values are shared, so the messages themselves cost the same
+either way.
+
+    python benchmarks/bench_sessions.py [sessions] [dispatches]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import tracemalloc
+
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ.setdefault('DB_PATH', os.path.join(tempfile.mkdtemp(prefix='ngl_bench_'), 'bench.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+ADMIN_ID = main.ADMIN_ID
+LINK = 'https://ngl.link/bench'
+MESSAGES = ['first message', 'second message', 'third message']
+BATCH_KEY = '0123456789abcdef'
+TEXT_STATES = ['awaiting_link', 'awaiting_custom', 'awaiting_count', None]
+CALLBACKS = ['enter_link', 'ai_message', 'lang_hindi', 'count_3', 'regenerate_all', 'custom_message',
+             'custom_2', 'message_type', 'check_membership', f'send_messages:{BATCH_KEY}', 'broadcast_text']
+
+
+# user_data as the old flow left it after link entry, custom count and message collection
+def old_session(state):
+    return {
+        'awaiting_link': state == 'awaiting_link',
+        'ngl_link': LINK,
+        'message_type': 'custom',
+        'language': 'english',
+        'message_count': 3,
+        'awaiting_count': state == 'awaiting_count',
+        'custom_messages': MESSAGES,
+        'awaiting_custom': state == 'awaiting_custom',
+        'current_custom_index': 3,
+        'messages': MESSAGES,
+        'batch_key': BATCH_KEY,
+    }
+
+
+def new_session(state):
+    session = main.Session()
+    session.state = state or main.STATE_IDLE
+    session.ngl_link = LINK
+    session.message_type = 'custom'
+    session.message_count = 3
+    session.custom_messages = MESSAGES
+    session.messages = MESSAGES
+    session.batch_key = BATCH_KEY
+    return session
+
+
+# The if/elif chains handle_text and handle_callback used before the state machine
+def old_text_dispatch(user_data, user_id):
+    if user_data.get('broadcast_type'):
+        return 'broadcast'
+    if user_data.get('awaiting_count') and user_id == ADMIN_ID:
+        return 'count'
+    elif user_data.get('awaiting_link'):
+        return 'link'
+    elif user_data.get('awaiting_custom'):
+        return 'custom'
+    return None
+
+
+def old_callback_dispatch(data):
+    if data == "batch_status":
+        return 'batch_status'
+    if data == "batch_cancel":
+        return 'batch_cancel'
+    if data == "enter_link":
+        return 'enter_link'
+    elif data == "check_membership":
+        return 'check_membership'
+    elif data == "message_type":
+        return 'message_type'
+    elif data == "ai_message":
+        return 'ai_message'
+    elif data.startswith("lang_"):
+        return 'lang'
+    elif data == "custom_message":
+        return 'custom_message'
+    elif data.startswith("custom_"):
+        return 'custom'
+    elif data.startswith("count_"):
+        return 'count'
+    elif data == "regenerate_all":
+        return 'regenerate_all'
+    elif data.startswith("send_messages"):
+        return 'send_messages'
+    elif data.startswith("broadcast_"):
+        return 'broadcast'
+    return None
+
+
+def new_callback_dispatch(data):
+    if data == "batch_status" or data == "batch_cancel":
+        return data
+    return main.callback_handler_for(data)
+
+
+def measure_memory(build, total):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    store = {user_id: build(TEXT_STATES[user_id % len(TEXT_STATES)]) for user_id in range(2, total + 2)}
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return store, used / total
+
+
+def bench_dispatch(label, store, text_dispatch, callback_dispatch, dispatches):
+    user_ids = random.choices(list(store), k=dispatches)
+    callbacks = random.choices(CALLBACKS, k=dispatches)
+
+    start = time.perf_counter()
+    for user_id in user_ids:
+        text_dispatch(store, user_id)
+    text_ns = (time.perf_counter() - start) / dispatches * 1e9
+
+    start = time.perf_counter()
+    for data in callbacks:
+        callback_dispatch(data)
+    callback_ns = (time.perf_counter() - start) / dispatches * 1e9
+    print(f"{label:28} text dispatch {text_ns:7.1f}ns  callback dispatch {callback_ns:7.1f}ns")
+
+
+def bench(total, dispatches):
+    random.seed(1)
+    print(f"sessions={total} dispatches={dispatches}")
+
+    old_store, old_bytes = measure_memory(old_session, total)
+    new_store, new_bytes = measure_memory(new_session, total)
+    print(f"{'before (user_data dict)':28} {old_bytes:7.1f} bytes/session")
+    print(f"{'after  (__slots__ Session)':28} {new_bytes:7.1f} bytes/session  ({old_bytes / new_bytes:.2f}x smaller)")
+
+    bench_dispatch("before (flags + if/elif)", old_store,
+                   lambda store, user_id: old_text_dispatch(store[user_id], user_id),
+                   old_callback_dispatch, dispatches)
+    main.sessions.update(new_store)
+    bench_dispatch("after  (state tables)", new_store,
+                   lambda store, user_id: main.TEXT_HANDLERS.get(main.get_session(user_id).state),
+                   new_callback_dispatch, dispatches)
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    dispatches = int(sys.argv[2]) if len(sys.argv) > 2 else 1_000_000
+    bench(total, dispatches)
@@ -0,0 +1,120 @@
+"""/track query latency on a large message log.
+
+Seeds a temporary messages table with millions of rows, then compares the old
+top-10 query (no secondary index - a full scan per /track) with the keyset
+pages served from the (user_id, timestamp) index, and with rendered pages
+coming from the LRU page cache.
+
+    python benchmarks/bench_track.py [rows] [users] [queries]
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import asyncio
+import tempfile
+from datetime import datetime, timedelta
+
+TMP_DIR = tempfile.mkdtemp(prefix='ngl_bench_')
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ['DB_PATH'] = os.path.join(TMP_DIR, 'track.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+STATUSES = ('success', 'success', 'success', 'failed', 'capped')
+
+
+def seed(rows, users):
+    conn = sqlite3.connect(os.environ['DB_PATH'])
+    conn.execute('''
+        CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            ngl_link TEXT,
+            message_text TEXT,
+            status TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    start = datetime(2024, 1, 1)
+    batch = []
+    for i in range(rows):
+        timestamp = (start + timedelta(seconds=i * 7)).strftime('%Y-%m-%d %H:%M:%S')
+        batch.append((random.randrange(2, users + 2), 'https://ngl.link/bench', f'message {i}', random.choice(STATUSES), timestamp))
+        if len(batch) == 50000:
+            conn.executemany('INSERT INTO messages (user_id, ngl_link, message_text, status, timestamp) VALUES (?, ?, ?, ?, ?)', batch)
+            batch.clear()
+    conn.executemany('INSERT INTO messages (user_id, ngl_link, message_text, status, timestamp) VALUES (?, ?, ?, ?, ?)', batch)
+    conn.commit()
+    return conn
+
+
+def timed(label, queries, func):
+    start = time.perf_counter()
+    for _ in range(queries):
+        func()
+    per_query = (time.perf_counter() - start) / queries
+    print(f"{label:40} {per_query * 1000:9.3f}ms/query")
+    return per_query
+
+
+async def timed_async(label, queries, func):
+    start = time.perf_counter()
+    for _ in range(queries):
+        await func()
+    per_query = (time.perf_counter() - start) / queries
+    print(f"{label:40} {per_query * 1000:9.3f}ms/query")
+    return per_query
+
+
+async def bench(rows, users, queries):
+    random.seed(1)
+    start = time.perf_counter()
+    conn = seed(rows, users)
+    print(f"rows={rows} users={users} (seeded in {time.perf_counter() - start:.1f}s)")
+    user_ids = [random.randrange(2, users + 2) for _ in range(queries)]
+    ids = iter(user_ids * 2)
+
+    # The query track_command ran before this change
+    before = timed("before: top 10, no index (full scan)", max(1, queries // 50), lambda: conn.execute(
+        'SELECT ngl_link, message_text, status, timestamp FROM messages WHERE user_id = ? ORDER BY timestamp DESC LIMIT 10',
+        (next(ids),)
+    ).fetchall())
+
+    start = time.perf_counter()
+    main.init_db()
+    print(f"{'init_db migrations (backfill + index)':40} {time.perf_counter() - start:9.3f}s")
+
+    ids = iter(user_ids * 2)
+    first = timed("after: first page (keyset + index)", queries, lambda: main.get_message_page(next(ids)))
+
+    # Walk the busiest user's log to the end with Older
+    busiest = conn.execute('SELECT user_id FROM messages GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1').fetchone()[0]
+    pages = 0
+    cursor = None
+    start = time.perf_counter()
+    while True:
+        page_rows, _, has_older = main.get_message_page(busiest, cursor)
+        pages += 1
+        if not has_older:
+            break
+        cursor = (page_rows[-1][4], page_rows[-1][0])
+    print(f"{'after: deepest page walk (per page)':40} {(time.perf_counter() - start) / pages * 1000:9.3f}ms/query ({pages} pages)")
+
+    ids = iter(user_ids * 2)
+    await timed_async("after: render, cold page cache", queries, lambda: main.render_track_page(next(ids)))
+    hot_user = user_ids[0]
+    await timed_async("after: render, cached page", queries, lambda: main.render_track_page(hot_user))
+
+    print(f"speedup (first page vs full scan): {before / first:.0f}x")
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 10_000
+    queries = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    main.track_pages.max_pages = queries
+    asyncio.run(bench(rows, users, queries))
+    main.close_db()
@@ -0,0 +1,86 @@
+"""Local stand-in for the Gemini generateContent endpoint.
+
+Answers with N numbered lines (N is read from the "Generate N different"
+part of the prompt) after a configurable delay, and can inject 429/503
+responses. Point the bot at it with GEMINI_API_URL for offline runs:
+
+    python benchmarks/fake_gemini.py --port 8765 --latency 0.8 --error-rate 0.1
+    GEMINI_API_URL=http://127.0.0.1:8765/generate python main.py
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COUNT_PATTERN = re.compile(r'Generate (\d+) different')
+
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.5, error_rate=0.0):
+        super().__init__(('127.0.0.1', port), FakeGeminiHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/generate"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.latency)
+            if random.random() < server.error_rate:
+                self._reply(random.choice((429, 503)), {"error": {"message": "injected failure"}})
+                return
+            prompt = json.loads(body)['contents'][0]['parts'][0]['text']
+            match = COUNT_PATTERN.search(prompt)
+            count = int(match.group(1)) if match else 1
+            lines = [f"fake message {random.randint(100000, 999999)}" for _ in range(count)]
+            self._reply(200, {"candidates": [{"content": {"parts": [{"text": "\n".join(lines)}]}}]})
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _reply(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.5)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    server = FakeGeminiServer(args.port, args.latency, args.error_rate)
+    print(f"Fake Gemini listening on {server.url}")
+    server.serve_forever()
@@ -3,25 +3,131 @@ import time
 import random
 import sqlite3
 import requests
+import httpx
 import threading
 import asyncio
+import re
+import json
+import csv
+import gzip
+import io
+import tempfile
+import uuid
+import logging
+import traceback
+from logging.handlers import RotatingFileHandler
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import pytz
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ChatMemberHandler, TypeHandler, ContextTypes, filters
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter, Forbidden, BadRequest
 from flask import Flask
 
 # Configuration from environment variables
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 ADMIN_ID = int(os.getenv('ADMIN_ID'))
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent"
+GEMINI_API_URL = os.getenv('GEMINI_API_URL', "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent")
+
+# Gemini client settings
+GEMINI_CONNECT_TIMEOUT = float(os.getenv('GEMINI_CONNECT_TIMEOUT', '3'))
+GEMINI_READ_TIMEOUT = float(os.getenv('GEMINI_READ_TIMEOUT', '10'))
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '2'))
+GEMINI_MAX_CONNECTIONS = int(os.getenv('GEMINI_MAX_CONNECTIONS', '10'))
+
+# AI generation mode: 'gemini' (phrase-bank fallback), 'auto' (Gemini with the local generator
+# as fallback) or 'local' (local generator only, no network)
+AI_MODE = os.getenv('AI_MODE', 'auto')
+MESSAGE_DATA_DIR = os.getenv('MESSAGE_DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'messages'))
+MAX_AI_MESSAGE_LENGTH = 50
+
+# Gemini circuit breaker settings
+GEMINI_BREAKER_WINDOW = int(os.getenv('GEMINI_BREAKER_WINDOW', '50'))
+GEMINI_BREAKER_MIN_CALLS = int(os.getenv('GEMINI_BREAKER_MIN_CALLS', '10'))
+GEMINI_BREAKER_ERROR_RATE = float(os.getenv('GEMINI_BREAKER_ERROR_RATE', '0.5'))
+GEMINI_BREAKER_COOLDOWN = float(os.getenv('GEMINI_BREAKER_COOLDOWN', '30'))
+GEMINI_MIN_READ_TIMEOUT = float(os.getenv('GEMINI_MIN_READ_TIMEOUT', '2'))
+GEMINI_TIMEOUT_MULTIPLIER = float(os.getenv('GEMINI_TIMEOUT_MULTIPLIER', '2'))
+
+# Pre-generated AI message pool settings
+AI_POOL_SIZE = int(os.getenv('AI_POOL_SIZE', '50'))
+AI_POOL_REFILL_THRESHOLD = int(os.getenv('AI_POOL_REFILL_THRESHOLD', '15'))
+AI_POOL_REFILL_BATCH = int(os.getenv('AI_POOL_REFILL_BATCH', '20'))
+AI_POOL_REFILL_INTERVAL = int(os.getenv('AI_POOL_REFILL_INTERVAL', '60'))
+AI_COALESCE_WINDOW_MS = int(os.getenv('AI_COALESCE_WINDOW_MS', '50'))
+AI_SEEN_HISTORY = 200  # AI messages remembered per user to avoid repeats
 
 # Group and Channel IDs for membership check - UPDATE THESE WITH YOUR ACTUAL LINKS
 GROUP_ID = "@premiumlinkers"  # Replace with your group username
 CHANNEL_ID = "@KiddingARENA"  # Replace with your channel username
 
+# Database settings
+DB_PATH = os.getenv('DB_PATH', 'ngl_bot.db')
+DB_WORKERS = int(os.getenv('DB_WORKERS', '4'))
+MESSAGE_LOG_BATCH_SIZE = int(os.getenv('MESSAGE_LOG_BATCH_SIZE', '50'))
+MESSAGE_LOG_FLUSH_MS = int(os.getenv('MESSAGE_LOG_FLUSH_MS', '500'))
+
+# Rate limit settings
+DAILY_LIMIT = 30
+RATE_LIMIT_WINDOW_SECONDS = 24 * 3600
+RATE_LIMIT_FLUSH_SECONDS = int(os.getenv('RATE_LIMIT_FLUSH_SECONDS', '5'))
+
+# Membership cache settings
+MEMBERSHIP_TTL_SECONDS = int(os.getenv('MEMBERSHIP_TTL_SECONDS', '600'))
+MEMBERSHIP_NEGATIVE_TTL_SECONDS = int(os.getenv('MEMBERSHIP_NEGATIVE_TTL_SECONDS', '30'))
+MEMBERSHIP_BACKFILL_DELAY = 0.05  # seconds between backfill lookups
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
+# Broadcast engine settings (Telegram allows ~30 msgs/sec overall and ~1 msg/sec per chat)
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_PER_CHAT_INTERVAL = float(os.getenv('BROADCAST_PER_CHAT_INTERVAL', '1'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '20'))
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', '100'))
+BROADCAST_MAX_ATTEMPTS = 3
+ACTIVITY_FLUSH_SECONDS = int(os.getenv('ACTIVITY_FLUSH_SECONDS', '30'))
+PROGRESS_UPDATE_INTERVAL = float(os.getenv('PROGRESS_UPDATE_INTERVAL', '3'))
+
+# Protective cap on submissions to one NGL username across all senders
+LINK_CAP_MAX = int(os.getenv('LINK_CAP_MAX', '60'))
+LINK_CAP_WINDOW_SECONDS = int(os.getenv('LINK_CAP_WINDOW_SECONDS', '3600'))
+
+# Idempotency keys for prepared send batches (duplicate taps / redelivered callbacks)
+BATCH_DEDUPE_MAX_KEYS = int(os.getenv('BATCH_DEDUPE_MAX_KEYS', '5000'))
+BATCH_DEDUPE_TTL_SECONDS = int(os.getenv('BATCH_DEDUPE_TTL_SECONDS', '86400'))
+
+# Admin notification digests (interval can be changed at runtime with /digest)
+ADMIN_DIGEST_INTERVAL = int(os.getenv('ADMIN_DIGEST_INTERVAL', '300'))
+ADMIN_DIGEST_MAX_EVENTS = int(os.getenv('ADMIN_DIGEST_MAX_EVENTS', '50'))
+ADMIN_DIGEST_EVENT_CHARS = 300
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# /track pagination
+TRACK_PAGE_SIZE = int(os.getenv('TRACK_PAGE_SIZE', '10'))
+TRACK_CACHE_SIZE = int(os.getenv('TRACK_CACHE_SIZE', '256'))
+
+# Admin exports
+EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', '5000'))
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # Telegram's upload limit for bots
+
+# Message retention - rows older than RETENTION_DAYS are moved to gzip archives (0 keeps everything)
+RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', '0'))
+RETENTION_INTERVAL_HOURS = float(os.getenv('RETENTION_INTERVAL_HOURS', '24'))
+RETENTION_CHUNK_ROWS = int(os.getenv('RETENTION_CHUNK_ROWS', '2000'))
+RETENTION_VACUUM_PAGES = 1000
+RETENTION_STARTUP_DELAY = 300
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archives')
+
+# Error reporting - full tracebacks go to a size-rotated log, the admin gets deduplicated alerts
+ERROR_LOG_PATH = os.getenv('ERROR_LOG_PATH', 'bot_errors.log')
+ERROR_LOG_MAX_BYTES = int(os.getenv('ERROR_LOG_MAX_BYTES', str(1024 * 1024)))
+ERROR_LOG_BACKUPS = int(os.getenv('ERROR_LOG_BACKUPS', '3'))
+ERROR_ALERT_INTERVAL = int(os.getenv('ERROR_ALERT_INTERVAL', '600'))
+ERROR_SUMMARY_INTERVAL = int(os.getenv('ERROR_SUMMARY_INTERVAL', '900'))
+ERROR_MAX_FINGERPRINTS = 500
+
 # Set your timezone
 TIMEZONE = pytz.timezone('Asia/Kolkata')
 
@@ -44,11 +150,53 @@ def home():
 def run_flask():
     app.run(host='0.0.0.0', port=5000, debug=False)
 
-# Initialize database
-def init_db():
-    conn = sqlite3.connect('ngl_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('''
+# Shared SQLite connections - one long-lived WAL connection per DB worker thread
+_db_local = threading.local()
+_db_connections = []
+_db_connections_lock = threading.Lock()
+_db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='db')
+
+def get_db():
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=30000')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-8000')
+        _db_local.conn = conn
+        with _db_connections_lock:
+            _db_connections.append(conn)
+    return conn
+
+# Run a blocking database function on the DB worker pool (keeps the event loop free)
+async def run_db(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, func, *args)
+
+# Close all shared connections (called on shutdown)
+def close_db():
+    _db_executor.shutdown(wait=True)
+    with _db_connections_lock:
+        for conn in _db_connections:
+            try:
+                # Refresh planner statistics so segment/range queries pick the right index
+                conn.execute('PRAGMA optimize')
+                conn.close()
+            except Exception as e:
+                print(f"DB close error: {e}")
+        _db_connections.clear()
+
+def add_column_if_missing(conn, table, column, definition):
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+# Schema migrations - PRAGMA user_version records the last one applied, each one runs once
+# v1: the schema as it was built up before versioned migrations (idempotent on existing databases)
+def migrate_v1_baseline(conn):
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -56,7 +204,7 @@ def init_db():
             last_reset TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -66,7 +214,7 @@ def init_db():
             timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS bot_users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -74,121 +222,1151 @@ def init_db():
             joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    conn.commit()
-    conn.close()
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS memberships (
+            chat_id TEXT,
+            user_id INTEGER,
+            is_member INTEGER,
+            updated_at REAL,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS bot_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            broadcast_type TEXT,
+            content TEXT,
+            photo_file_id TEXT,
+            from_chat_id INTEGER,
+            message_id INTEGER,
+            status_message_id INTEGER,
+            status TEXT DEFAULT 'running',
+            cursor INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            success_count INTEGER DEFAULT 0,
+            failed_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+
+    # Columns added after the original schema
+    add_column_if_missing(conn, 'bot_users', 'active', 'INTEGER DEFAULT 1')
+    add_column_if_missing(conn, 'bot_users', 'inactive_reason', 'TEXT')
+    add_column_if_missing(conn, 'bot_users', 'inactive_at', 'TIMESTAMP')
+    add_column_if_missing(conn, 'broadcast_jobs', 'pruned_count', 'INTEGER DEFAULT 0')
+    add_column_if_missing(conn, 'bot_users', 'last_active_at', 'TIMESTAMP')
+    add_column_if_missing(conn, 'bot_users', 'verified_at', 'TIMESTAMP')
+    add_column_if_missing(conn, 'broadcast_jobs', 'segment', "TEXT DEFAULT 'all'")
+    add_column_if_missing(conn, 'broadcast_jobs', 'segment_since', 'TIMESTAMP')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_bot_users_active ON bot_users (active, user_id)')
+
+    # Indexes backing the broadcast segments
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_bot_users_joined ON bot_users (joined_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_bot_users_last_active ON bot_users (last_active_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_bot_users_verified ON bot_users (verified_at)')
+    # /track pages by (user_id, timestamp); the composite index also covers user_id lookups
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_time ON messages (user_id, timestamp)')
+    conn.execute('DROP INDEX IF EXISTS idx_messages_user')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)')
+
+# Integer epoch seconds for a time column written as CURRENT_TIMESTAMP / ISO text (NULL stays NULL)
+def epoch_sql(column):
+    return f"CAST(strftime('%s', {column}) AS INTEGER)"
+
+EPOCH_NOW_SQL = epoch_sql("'now'")
+
+# Recreate a table with a new definition, copying rows and converting the given columns to epoch seconds
+def rebuild_table(conn, table, definition, epoch_columns):
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    select = ', '.join(epoch_sql(column) if column in epoch_columns else column for column in columns)
+    conn.execute(f'CREATE TABLE {table}_new ({definition})')
+    conn.execute(f"INSERT INTO {table}_new ({', '.join(columns)}) SELECT {select} FROM {table}")
+    conn.execute(f'DROP TABLE {table}')
+    conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+
+# v2: every time column becomes INTEGER epoch seconds (UTC), existing rows are backfilled
+def migrate_v2_epoch_timestamps(conn):
+    rebuild_table(conn, 'users', f'''
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        message_count INTEGER DEFAULT 0,
+        last_reset INTEGER DEFAULT ({EPOCH_NOW_SQL})
+    ''', ('last_reset',))
+    rebuild_table(conn, 'messages', f'''
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        ngl_link TEXT,
+        message_text TEXT,
+        status TEXT,
+        timestamp INTEGER DEFAULT ({EPOCH_NOW_SQL})
+    ''', ('timestamp',))
+    rebuild_table(conn, 'bot_users', f'''
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        joined_at INTEGER DEFAULT ({EPOCH_NOW_SQL}),
+        active INTEGER DEFAULT 1,
+        inactive_reason TEXT,
+        inactive_at INTEGER,
+        last_active_at INTEGER,
+        verified_at INTEGER
+    ''', ('joined_at', 'inactive_at', 'last_active_at', 'verified_at'))
+    rebuild_table(conn, 'broadcast_jobs', f'''
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        broadcast_type TEXT,
+        content TEXT,
+        photo_file_id TEXT,
+        from_chat_id INTEGER,
+        message_id INTEGER,
+        status_message_id INTEGER,
+        status TEXT DEFAULT 'running',
+        cursor INTEGER DEFAULT 0,
+        total INTEGER DEFAULT 0,
+        success_count INTEGER DEFAULT 0,
+        failed_count INTEGER DEFAULT 0,
+        created_at INTEGER DEFAULT ({EPOCH_NOW_SQL}),
+        finished_at INTEGER,
+        pruned_count INTEGER DEFAULT 0,
+        segment TEXT DEFAULT 'all',
+        segment_since INTEGER
+    ''', ('created_at', 'finished_at', 'segment_since'))
+
+    # Dropping the old tables dropped their indexes
+    conn.execute('CREATE INDEX idx_bot_users_active ON bot_users (active, user_id)')
+    conn.execute('CREATE INDEX idx_bot_users_joined ON bot_users (joined_at)')
+    conn.execute('CREATE INDEX idx_bot_users_last_active ON bot_users (last_active_at)')
+    conn.execute('CREATE INDEX idx_bot_users_verified ON bot_users (verified_at)')
+    conn.execute('CREATE INDEX idx_messages_user_time ON messages (user_id, timestamp)')
+    conn.execute('CREATE INDEX idx_messages_timestamp ON messages (timestamp)')
+
+# v3: rollup tables behind /stats, backfilled from the existing rows
+def migrate_v3_stats_rollups(conn):
+    conn.execute('''
+        CREATE TABLE daily_stats (
+            day TEXT PRIMARY KEY,
+            sends INTEGER DEFAULT 0,
+            success INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            capped INTEGER DEFAULT 0,
+            new_users INTEGER DEFAULT 0,
+            active_users INTEGER DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE daily_active_users (
+            day TEXT,
+            user_id INTEGER,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE ai_usage (
+            day TEXT,
+            language TEXT,
+            messages INTEGER DEFAULT 0,
+            PRIMARY KEY (day, language)
+        ) WITHOUT ROWID
+    ''')
+    rebuild_daily_stats(conn)
+
+# v4: sends counts messages actually sent (success + failed); capped ones are only in capped
+def migrate_v4_sends_exclude_capped(conn):
+    conn.execute('UPDATE daily_stats SET sends = success + failed')
+
+MIGRATIONS = [migrate_v1_baseline, migrate_v2_epoch_timestamps, migrate_v3_stats_rollups,
+              migrate_v4_sends_exclude_capped]
+
+# Initialize database - apply pending migrations, each in its own transaction with its version bump
+def init_db():
+    conn = get_db()
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    # A new database starts out with incremental auto-vacuum - the VACUUM is instant while it is empty
+    if conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()[0] == 0:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute('BEGIN IMMEDIATE')
+        with conn:
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {number}')
+        print(f"Database migrated to schema v{number}")
+    if RETENTION_DAYS > 0:
+        enable_incremental_vacuum()
+
+def incremental_vacuum_enabled():
+    conn = get_db()
+    # Read the schema first - the pragma alone can return a value cached before another connection converted
+    conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+    return conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+# Incremental auto-vacuum lets retention hand freed pages back in small steps. Switching an existing
+# database over rewrites the whole file with one VACUUM, so it only happens once retention is in use
+# (RETENTION_DAYS set, or the first /retention run). Returns True if the database was converted.
+def enable_incremental_vacuum():
+    if incremental_vacuum_enabled():
+        return False
+    conn = get_db()
+    print("Switching the database to incremental auto-vacuum (one-time VACUUM)...")
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    print("Database switched to incremental auto-vacuum")
+    return True
 
 # Get current time with timezone
 def get_current_time():
     return datetime.now(TIMEZONE)
 
+# Current time (optionally shifted back) as integer epoch seconds - the format every time column uses
+def epoch_seconds(days_ago=0, seconds_ago=0):
+    return int(time.time()) - days_ago * 86400 - seconds_ago
+
+# Epoch seconds from the database as local time text for display
+def format_epoch(value, fmt='%m/%d %H:%M'):
+    return datetime.fromtimestamp(value, TIMEZONE).strftime(fmt) if value is not None else 'N/A'
+
+# Stats rollups - daily counters kept up to date in the same transaction as the rows they count,
+# so /stats never has to aggregate messages or bot_users
+STATS_DAY_MODIFIER = f"{int(TIMEZONE.utcoffset(datetime.now()).total_seconds() // 60):+d} minutes"
+
+# Local calendar day (bot timezone) of an epoch timestamp, as stored in the rollup tables
+def stats_day(epoch=None):
+    return datetime.fromtimestamp(time.time() if epoch is None else epoch, TIMEZONE).strftime('%Y-%m-%d')
+
+def bump_daily_stats(conn, day, **counts):
+    columns = ', '.join(counts)
+    placeholders = ', '.join('?' for _ in counts)
+    updates = ', '.join(f'{column} = {column} + excluded.{column}' for column in counts)
+    conn.execute(
+        f'INSERT INTO daily_stats (day, {columns}) VALUES (?, {placeholders}) ON CONFLICT(day) DO UPDATE SET {updates}',
+        (day, *counts.values())
+    )
+
+# Count flushed message-log rows into daily_stats (called inside the flush transaction).
+# Capped messages were never sent, so they are counted apart from sends.
+def record_send_stats(conn, rows):
+    per_day = {}
+    for _, _, _, status, timestamp in rows:
+        counts = per_day.setdefault(stats_day(timestamp), {'sends': 0, 'success': 0, 'failed': 0, 'capped': 0})
+        if status == 'capped':
+            counts['capped'] += 1
+            continue
+        counts['sends'] += 1
+        counts['success' if status == 'success' else 'failed'] += 1
+    for day, counts in per_day.items():
+        bump_daily_stats(conn, day, **counts)
+
+# AI usage rows are (day, language, messages), buffered by ActivityTracker
+def save_ai_usage(rows):
+    conn = get_db()
+    with conn:
+        conn.executemany('''
+            INSERT INTO ai_usage (day, language, messages) VALUES (?, ?, ?)
+            ON CONFLICT(day, language) DO UPDATE SET messages = messages + excluded.messages
+        ''', rows)
+
+# Recompute daily_stats from the raw rows: messages, bot_users.joined_at and daily_active_users.
+# ai_usage has no raw rows behind it and is left as is. Days before the retention boundary have
+# had their raw rows archived, so their rollups are kept instead of being recomputed.
+def rebuild_daily_stats(conn):
+    row = conn.execute("SELECT value FROM bot_meta WHERE key = 'retention_boundary_day'").fetchone()
+    boundary = row[0] if row else ''
+    conn.execute('DELETE FROM daily_stats WHERE day >= ?', (boundary,))
+    conn.execute('''
+        INSERT INTO daily_stats (day, sends, success, failed, capped)
+        SELECT date(timestamp, 'unixepoch', ?) AS day,
+               SUM(status != 'capped'),
+               SUM(status = 'success'),
+               SUM(status NOT IN ('success', 'capped')),
+               SUM(status = 'capped')
+        FROM messages
+        WHERE timestamp IS NOT NULL
+        GROUP BY day
+        HAVING day >= ?
+    ''', (STATS_DAY_MODIFIER, boundary))
+    conn.execute('''
+        INSERT INTO daily_stats (day, new_users)
+        SELECT date(joined_at, 'unixepoch', ?) AS day, COUNT(*)
+        FROM bot_users
+        WHERE joined_at IS NOT NULL
+        GROUP BY day
+        HAVING day >= ?
+        ON CONFLICT(day) DO UPDATE SET new_users = excluded.new_users
+    ''', (STATS_DAY_MODIFIER, boundary))
+    conn.execute('''
+        INSERT INTO daily_stats (day, active_users)
+        SELECT day, COUNT(*) FROM daily_active_users WHERE day >= ? GROUP BY day
+        ON CONFLICT(day) DO UPDATE SET active_users = excluded.active_users
+    ''', (boundary,))
+
+def rebuild_stats():
+    conn = get_db()
+    with conn:
+        rebuild_daily_stats(conn)
+        return conn.execute('SELECT COUNT(*) FROM daily_stats').fetchone()[0]
+
+STATS_COLUMNS = ('day', 'sends', 'success', 'failed', 'capped', 'new_users', 'active_users')
+
+# Rollup rows for /stats: the last `days` days, all-time totals and AI usage per language
+def get_stats(days):
+    conn = get_db()
+    since = stats_day(epoch_seconds(days - 1))
+    recent = conn.execute(
+        f"SELECT {', '.join(STATS_COLUMNS)} FROM daily_stats WHERE day >= ? ORDER BY day DESC", (since,)
+    ).fetchall()
+    totals = conn.execute(
+        'SELECT COUNT(*), SUM(sends), SUM(success), SUM(failed), SUM(capped), SUM(new_users) FROM daily_stats'
+    ).fetchone()
+    ai_recent = conn.execute(
+        'SELECT language, SUM(messages) FROM ai_usage WHERE day >= ? GROUP BY language ORDER BY 2 DESC', (since,)
+    ).fetchall()
+    return recent, totals, ai_recent
+
 # Track bot users
 def track_bot_user(user_id, username, first_name):
     try:
-        conn = sqlite3.connect('ngl_bot.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO bot_users (user_id, username, first_name) 
-            VALUES (?, ?, ?)
-        ''', (user_id, username, first_name))
-        conn.commit()
-        conn.close()
+        conn = get_db()
+        with conn:
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO bot_users (user_id, username, first_name) VALUES (?, ?, ?)',
+                (user_id, username, first_name)
+            )
+            if cursor.rowcount:
+                bump_daily_stats(conn, stats_day(), new_users=1)
+            else:
+                # A user talking to the bot is reachable again, so clear any pruning
+                conn.execute('''
+                    UPDATE bot_users SET
+                        username = ?,
+                        first_name = ?,
+                        active = 1,
+                        inactive_reason = NULL,
+                        inactive_at = NULL
+                    WHERE user_id = ?
+                ''', (username, first_name, user_id))
     except Exception as e:
         print(f"Track user error: {e}")
 
-# Get all bot users for broadcast (excluding admin)
-def get_all_bot_users():
-    try:
-        conn = sqlite3.connect('ngl_bot.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id FROM bot_users WHERE user_id != ?', (ADMIN_ID,))
-        users = [row[0] for row in cursor.fetchall()]
-        conn.close()
-        return users
-    except Exception as e:
-        print(f"Get users error: {e}")
-        return []
-
-# Rate limiting functions
-def check_rate_limit(user_id):
-    conn = sqlite3.connect('ngl_bot.db')
-    cursor = conn.cursor()
+# Broadcast segments - each one is a filter on bot_users backed by an index
+BROADCAST_SEGMENTS = {
+    'all': ('', 'Everyone'),
+    'joined': ('joined_at >= ?', 'Joined in the last {days} days'),
+    'active': ('last_active_at >= ?', 'Active in the last {days} days'),
+    'senders': ('EXISTS (SELECT 1 FROM messages WHERE messages.user_id = bot_users.user_id)', 'Has sent messages'),
+    # verified_at only exists since it was tracked, so members of both chats (memberships only holds
+    # GROUP_ID and CHANNEL_ID rows) count as verified too. Uncorrelated, so it is evaluated once per query.
+    'unverified': ('''verified_at IS NULL AND user_id NOT IN (
+        SELECT user_id FROM memberships WHERE is_member = 1 GROUP BY user_id HAVING COUNT(*) >= 2
+    )''', 'Never verified membership'),
+}
+SEGMENTS_WITH_DAYS = ('joined', 'active')
+
+def segment_filter(segment, since):
+    condition = BROADCAST_SEGMENTS[segment][0]
+    if not condition:
+        return '', ()
+    return f' AND {condition}', ((since,) if '?' in condition else ())
+
+# Broadcast recipients (active users in a segment, excluding admin), streamed in user_id order after a keyset cursor
+def get_broadcast_recipients(after_user_id, limit, segment='all', since=None):
+    conn = get_db()
+    condition, params = segment_filter(segment, since)
+    cursor = conn.execute(
+        f'SELECT user_id FROM bot_users WHERE active = 1 AND user_id > ? AND user_id != ?{condition} ORDER BY user_id LIMIT ?',
+        (after_user_id, ADMIN_ID, *params, limit)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+def count_broadcast_recipients(segment='all', since=None):
+    conn = get_db()
+    condition, params = segment_filter(segment, since)
+    return conn.execute(
+        f'SELECT COUNT(*) FROM bot_users WHERE active = 1 AND user_id != ?{condition}',
+        (ADMIN_ID, *params)
+    ).fetchone()[0]
+
+# Activity and verification timestamps are buffered in memory and written in batches
+def save_user_activity(active_rows, verified_rows):
+    conn = get_db()
+    with conn:
+        conn.executemany('UPDATE bot_users SET last_active_at = ? WHERE user_id = ?', active_rows)
+        # First activity of a bot user on a day counts towards that day's active users
+        per_day = {}
+        for active_at, user_id in active_rows:
+            per_day.setdefault(stats_day(active_at), []).append(user_id)
+        for day, user_ids in per_day.items():
+            cursor = conn.executemany('''
+                INSERT OR IGNORE INTO daily_active_users (day, user_id)
+                SELECT ?, user_id FROM bot_users WHERE user_id = ?
+            ''', [(day, user_id) for user_id in user_ids])
+            if cursor.rowcount:
+                bump_daily_stats(conn, day, active_users=cursor.rowcount)
+        conn.executemany('UPDATE bot_users SET verified_at = COALESCE(verified_at, ?) WHERE user_id = ?', verified_rows)
+
+class ActivityTracker:
+    def __init__(self):
+        self._active = {}
+        self._verified = {}
+        self._known_verified = set()
+        self._ai_usage = {}
+
+    def touch(self, user_id):
+        self._active[user_id] = epoch_seconds()
+
+    def count_ai_messages(self, language, count):
+        key = (stats_day(), language)
+        self._ai_usage[key] = self._ai_usage.get(key, 0) + count
+
+    def mark_verified(self, user_id):
+        if user_id not in self._known_verified:
+            self._known_verified.add(user_id)
+            self._verified[user_id] = epoch_seconds()
+
+    # Failed writes are put back so the next flush retries them
+    async def flush(self):
+        if self._ai_usage:
+            ai_usage, self._ai_usage = self._ai_usage, {}
+            try:
+                await run_db(save_ai_usage, [(day, language, count) for (day, language), count in ai_usage.items()])
+            except Exception as e:
+                print(f"AI usage stats error: {e}")
+                for key, count in ai_usage.items():
+                    self._ai_usage[key] = self._ai_usage.get(key, 0) + count
+        if not self._active and not self._verified:
+            return
+        active, self._active = self._active, {}
+        verified, self._verified = self._verified, {}
+        try:
+            await run_db(save_user_activity,
+                         [(ts, user_id) for user_id, ts in active.items()],
+                         [(ts, user_id) for user_id, ts in verified.items()])
+        except Exception as e:
+            print(f"Activity flush error: {e}")
+            for user_id, ts in active.items():
+                self._active[user_id] = max(ts, self._active.get(user_id, ts))
+            for user_id, ts in verified.items():
+                self._verified.setdefault(user_id, ts)
+
+    async def run(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+user_activity = ActivityTracker()
+
+# Dead-user pruning - users who blocked the bot or deleted their account are skipped by broadcasts
+def mark_users_inactive(user_ids, reason):
+    conn = get_db()
+    now = epoch_seconds()
+    with conn:
+        conn.executemany(
+            'UPDATE bot_users SET active = 0, inactive_reason = ?, inactive_at = ? WHERE user_id = ?',
+            [(reason, now, user_id) for user_id in user_ids]
+        )
 
-    cursor.execute('SELECT last_reset, message_count FROM users WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
+def get_inactive_users(limit):
+    conn = get_db()
+    total = conn.execute('SELECT COUNT(*) FROM bot_users WHERE active = 0').fetchone()[0]
+    cursor = conn.execute('''
+        SELECT user_id, username, inactive_reason, inactive_at
+        FROM bot_users
+        WHERE active = 0
+        ORDER BY inactive_at DESC
+        LIMIT ?
+    ''', (limit,))
+    return total, cursor.fetchall()
+
+def restore_users(user_ids=None):
+    conn = get_db()
+    with conn:
+        if user_ids is None:
+            cursor = conn.execute('UPDATE bot_users SET active = 1, inactive_reason = NULL, inactive_at = NULL WHERE active = 0')
+        else:
+            cursor = conn.executemany(
+                'UPDATE bot_users SET active = 1, inactive_reason = NULL, inactive_at = NULL WHERE user_id = ? AND active = 0',
+                [(user_id,) for user_id in user_ids]
+            )
+        return cursor.rowcount
+
+# Broadcast job storage
+BROADCAST_JOB_COLUMNS = ('id', 'broadcast_type', 'content', 'photo_file_id', 'from_chat_id', 'message_id',
+                         'status_message_id', 'status', 'cursor', 'total', 'success_count', 'failed_count',
+                         'pruned_count', 'segment', 'segment_since')
+
+def create_broadcast_job(broadcast_type, content, photo_file_id, from_chat_id, message_id, status_message_id, total,
+                         segment, segment_since):
+    conn = get_db()
+    with conn:
+        cursor = conn.execute('''
+            INSERT INTO broadcast_jobs (broadcast_type, content, photo_file_id, from_chat_id, message_id, status_message_id,
+                                        total, segment, segment_since)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (broadcast_type, content, photo_file_id, from_chat_id, message_id, status_message_id, total,
+              segment, segment_since))
+        return cursor.lastrowid
+
+def get_broadcast_jobs(status):
+    conn = get_db()
+    cursor = conn.execute(f"SELECT {', '.join(BROADCAST_JOB_COLUMNS)} FROM broadcast_jobs WHERE status = ? ORDER BY id", (status,))
+    return [dict(zip(BROADCAST_JOB_COLUMNS, row)) for row in cursor.fetchall()]
+
+def get_broadcast_job(job_id):
+    conn = get_db()
+    row = conn.execute(f"SELECT {', '.join(BROADCAST_JOB_COLUMNS)} FROM broadcast_jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(zip(BROADCAST_JOB_COLUMNS, row)) if row else None
+
+def update_broadcast_progress(job_id, cursor, success_count, failed_count, pruned_count):
+    conn = get_db()
+    with conn:
+        conn.execute(
+            'UPDATE broadcast_jobs SET cursor = ?, success_count = ?, failed_count = ?, pruned_count = ? WHERE id = ?',
+            (cursor, success_count, failed_count, pruned_count, job_id)
+        )
 
-    if result:
-        last_reset = datetime.fromisoformat(result[0])
-        message_count = result[1]
+def finish_broadcast_job(job_id, status):
+    conn = get_db()
+    with conn:
+        conn.execute(
+            'UPDATE broadcast_jobs SET status = ?, finished_at = ? WHERE id = ?',
+            (status, epoch_seconds(), job_id)
+        )
 
-        # Reset if 24 hours passed
-        if get_current_time() - last_reset > timedelta(hours=24):
-            cursor.execute('UPDATE users SET message_count = 0, last_reset = ? WHERE user_id = ?', 
-                         (get_current_time(), user_id))
-            conn.commit()
-            current_count = 0
-        else:
-            current_count = message_count
-    else:
-        cursor.execute('INSERT INTO users (user_id, message_count, last_reset) VALUES (?, ?, ?)', 
-                     (user_id, 0, get_current_time()))
-        conn.commit()
-        current_count = 0
-
-    conn.close()
-    return current_count
-
-def update_rate_limit(user_id, count):
-    conn = sqlite3.connect('ngl_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET message_count = message_count + ? WHERE user_id = ?', (count, user_id))
-    conn.commit()
-    conn.close()
-
-# Generate message with Gemini API
-def generate_gemini_message(language="english", count=1):
-    try:
-        language_prompts = {
-            'english': 'Generate short, fun anonymous messages in English only.',
-            'hindi': 'Generate short, fun anonymous messages in Hindi only.',
-            'nepali': 'Generate short, fun anonymous messages in Nepali only.', 
-            'russian': 'Generate short, fun anonymous messages in Russian only.',
-            'hinglish': 'Generate short, fun anonymous messages in Hinglish only.'
-        }
+# Rate limiting - per-user counters live in memory, SQLite is only the backing store
+def load_rate_limit(user_id):
+    conn = get_db()
+    cursor = conn.execute('SELECT message_count, last_reset FROM users WHERE user_id = ?', (user_id,))
+    return cursor.fetchone()
+
+def save_rate_limits(rows):
+    conn = get_db()
+    with conn:
+        conn.executemany('''
+            INSERT INTO users (user_id, message_count, last_reset) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                message_count = excluded.message_count,
+                last_reset = excluded.last_reset
+        ''', rows)
+
+class RateLimiter:
+    def __init__(self, limit, window_seconds):
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self._state = {}  # user_id -> [message_count, reset_started_at]
+        self._loading = {}
+        self._dirty = set()
+
+    async def _get_state(self, user_id):
+        state = self._state.get(user_id)
+        if state is None:
+            # Concurrent first lookups for the same user share one DB read
+            loading = self._loading.get(user_id)
+            if loading is None:
+                loading = asyncio.ensure_future(run_db(load_rate_limit, user_id))
+                self._loading[user_id] = loading
+            try:
+                row = await loading
+            finally:
+                self._loading.pop(user_id, None)
+            state = self._state.get(user_id)
+            if state is None:
+                if row:
+                    state = [row[0], row[1]]
+                else:
+                    state = [0, time.time()]
+                    self._dirty.add(user_id)
+                self._state[user_id] = state
+
+        # Reset if the window has passed
+        now = time.time()
+        if now - state[1] > self.window_seconds:
+            state[0] = 0
+            state[1] = now
+            self._dirty.add(user_id)
+        return state
+
+    async def get_count(self, user_id):
+        state = await self._get_state(user_id)
+        return state[0]
+
+    # Atomically check and reserve quota; returns (allowed, count_before)
+    async def reserve(self, user_id, count):
+        state = await self._get_state(user_id)
+        # No await between the check and the increment, so concurrent batches can't both pass
+        current_count = state[0]
+        if current_count + count > self.limit:
+            return False, current_count
+        state[0] += count
+        self._dirty.add(user_id)
+        return True, current_count
+
+    def refund(self, user_id, count):
+        state = self._state.get(user_id)
+        if state is None or count <= 0:
+            return
+        state[0] = max(0, state[0] - count)
+        self._dirty.add(user_id)
+
+    def seconds_until_reset(self, user_id):
+        state = self._state.get(user_id)
+        if state is None:
+            return None
+        return max(0, state[1] + self.window_seconds - time.time())
+
+    async def flush(self):
+        if not self._dirty:
+            return 0
+        dirty, self._dirty = self._dirty, set()
+        rows = []
+        for user_id in dirty:
+            count, reset_started_at = self._state[user_id]
+            rows.append((user_id, count, int(reset_started_at)))
+        try:
+            await run_db(save_rate_limits, rows)
+        except Exception as e:
+            print(f"Rate limit flush error: {e}")
+            self._dirty |= dirty
+            return 0
+
+        # Forget users whose window has expired and who have nothing left to persist
+        now = time.time()
+        for user_id in [uid for uid, state in self._state.items() if now - state[1] > self.window_seconds]:
+            if user_id not in self._dirty:
+                del self._state[user_id]
+        return len(rows)
+
+rate_limiter = RateLimiter(DAILY_LIMIT, RATE_LIMIT_WINDOW_SECONDS)
+
+# Background task: persist changed rate-limit counters
+async def rate_limit_writer():
+    while True:
+        await asyncio.sleep(RATE_LIMIT_FLUSH_SECONDS)
+        await rate_limiter.flush()
+
+def format_limit_exceeded(user_id):
+    seconds_left = rate_limiter.seconds_until_reset(user_id)
+    if seconds_left is None:
+        return f"❌ Daily limit exceeded! You can only send {DAILY_LIMIT} messages per 24 hours.\n\nNeed help? Contact admin!"
+    hours_left = int(seconds_left // 3600)
+    minutes_left = int((seconds_left % 3600) // 60)
+    return f"❌ Daily limit exceeded! You can only send {DAILY_LIMIT} messages per 24 hours.\n\n⏰ Time remaining: {hours_left}h {minutes_left}m\n\nNeed help? Contact admin!"
+
+# Built-in phrase bank - served instantly when Gemini is slow, down or short on lines
+FALLBACK_MESSAGES = {
+    'english': [
+        "Your vibe is honestly unmatched 😄",
+        "Who taught you to be this cool?",
+        "You make boring days way better",
+        "Secret admirer here, just saying hi 👋",
+        "Your playlist probably slaps",
+        "Be honest, what's your comfort movie?",
+        "You're lowkey the funniest person I know",
+        "Tell me your most random talent",
+        "Okay but your smile though 😊",
+        "Best trip you've ever taken?",
+        "You deserve all the good things today",
+        "Pineapple on pizza: yes or no?",
+        "Someone here thinks you're awesome",
+        "What song is stuck in your head?",
+        "Your energy is contagious ✨",
+    ],
+    'hindi': [
+        "तुम्हारी स्माइल बहुत प्यारी है 😊",
+        "सच बताओ, तुम्हारा क्रश कौन है?",
+        "तुमसे बात करके दिन बन जाता है",
+        "तुम्हारा फेवरेट गाना कौन सा है?",
+        "कोई तुम्हें चुपके से पसंद करता है",
+        "तुम बहुत फनी हो यार 😄",
+        "आज का दिन कैसा रहा?",
+        "तुम्हारी वाइब कमाल की है ✨",
+        "अपना सबसे बड़ा सपना बताओ",
+        "चाय या कॉफी? सच बोलना",
+        "तुम्हारी हंसी बहुत अच्छी है",
+        "एक राज़ बताओ जो कोई नहीं जानता",
+    ],
+    'nepali': [
+        "तिम्रो मुस्कान एकदमै राम्रो छ 😊",
+        "साँचो भन, तिम्रो क्रश को हो?",
+        "तिमीसँग कुरा गर्दा रमाइलो लाग्छ",
+        "तिम्रो मनपर्ने गीत कुन हो?",
+        "कसैले तिमीलाई लुकेर मन पराउँछ",
+        "तिमी साह्रै रमाइलो मान्छे हौ 😄",
+        "आजको दिन कस्तो रह्यो?",
+        "तिम्रो भाइब गजबको छ ✨",
+        "तिम्रो सबैभन्दा ठूलो सपना के हो?",
+        "चिया कि कफी? साँचो भन",
+        "तिम्रो हाँसो धेरै मीठो छ",
+        "कसैलाई नभनेको एउटा कुरा भन",
+    ],
+    'russian': [
+        "У тебя очень милая улыбка 😊",
+        "Признайся, кто тебе нравится?",
+        "С тобой всегда весело",
+        "Какая твоя любимая песня?",
+        "Кто-то тайно тобой восхищается",
+        "Ты самый смешной человек 😄",
+        "Как прошёл твой день?",
+        "У тебя классная энергетика ✨",
+        "О чём ты мечтаешь больше всего?",
+        "Чай или кофе? Только честно",
+        "Твой смех просто заразительный",
+        "Расскажи секрет, который никто не знает",
+    ],
+    'hinglish': [
+        "Tumhari smile bahut cute hai 😊",
+        "Sach batao, crush kaun hai?",
+        "Tumse baat karke mood ban jata hai",
+        "Favourite song kaunsa hai tumhara?",
+        "Koi tumhe secretly pasand karta hai",
+        "Tum bahut funny ho yaar 😄",
+        "Aaj ka din kaisa raha?",
+        "Tumhari vibe ekdum mast hai ✨",
+        "Apna sabse bada sapna batao",
+        "Chai ya coffee? Sach bolna",
+        "Tumhari hansi bahut pyaari hai",
+        "Ek secret batao jo koi nahi jaanta",
+    ],
+}
 
-        base_prompt = language_prompts.get(language, language_prompts['english'])
+def fallback_messages(language, count, exclude=()):
+    bank = FALLBACK_MESSAGES.get(language, FALLBACK_MESSAGES['english'])
+    candidates = [msg for msg in bank if msg not in exclude] or bank
+    if count <= len(candidates):
+        return random.sample(candidates, count)
+    return [random.choice(candidates) for _ in range(count)]
+
+# Local message generator - fills per-language templates from data/messages/<language>.json
+class LocalMessageGenerator:
+    SLOT_PATTERN = re.compile(r'{(\w+)}')
+
+    def __init__(self, data_dir, max_length):
+        self.max_length = max_length
+        self._templates = {}  # language -> [(template, [slot names])]
+        self._slots = {}
+        self.generated = 0
+        for language in LANGUAGES:
+            path = os.path.join(data_dir, f"{language}.json")
+            try:
+                with open(path, encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Local generator data error ({language}): {e}")
+                continue
+            self._templates[language] = [(template, self.SLOT_PATTERN.findall(template)) for template in data['templates']]
+            self._slots[language] = data['slots']
+
+    def supports(self, language):
+        return language in self._templates
+
+    def _make(self, language):
+        template, slot_names = random.choice(self._templates[language])
+        slots = self._slots[language]
+        message = template.format(**{name: random.choice(slots[name]) for name in slot_names})
+        return message[0].upper() + message[1:]
+
+    # Returns up to count distinct messages, skipping anything in exclude
+    def generate(self, language, count, exclude=()):
+        if language not in self._templates:
+            language = 'english'
+        messages = []
+        seen = set(exclude)
+        attempts = 0
+        while len(messages) < count and attempts < count * 10:
+            attempts += 1
+            message = self._make(language)
+            if message in seen or len(message) > self.max_length:
+                continue
+            seen.add(message)
+            messages.append(message)
+        self.generated += len(messages)
+        return messages
+
+local_generator = LocalMessageGenerator(MESSAGE_DATA_DIR, MAX_AI_MESSAGE_LENGTH)
+
+# Offline messages for when Gemini can't be used - local generator in auto/local mode, phrase bank otherwise
+def offline_messages(language, count, exclude=()):
+    messages = []
+    if AI_MODE in ('auto', 'local') and local_generator.supports(language):
+        messages = local_generator.generate(language, count, exclude)
+    if len(messages) < count:
+        messages += fallback_messages(language, count - len(messages), exclude=set(exclude) | set(messages))
+    return messages
+
+class CircuitOpenError(Exception):
+    pass
+
+# Circuit breaker - opens on a high recent error rate, and derives the read timeout from observed p99 latency
+class CircuitBreaker:
+    def __init__(self, window, min_calls, error_rate, cooldown, min_timeout, max_timeout, timeout_multiplier):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_multiplier = timeout_multiplier
+        self._results = deque(maxlen=window)
+        self._latencies = deque(maxlen=window)
+        self.state = 'closed'
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.rejected = 0
+
+    def allow(self):
+        if self.state == 'closed':
+            return True
+        if self.state == 'open' and time.monotonic() - self._opened_at >= self.cooldown:
+            self.state = 'half_open'
+        if self.state == 'half_open' and not self._probe_in_flight:
+            # Let exactly one probe through
+            self._probe_in_flight = True
+            return True
+        self.rejected += 1
+        return False
 
-        url = f"{GEMINI_API_URL}?key={GEMINI_API_KEY}"
+    def record_success(self, latency):
+        self._latencies.append(latency)
+        self._results.append(True)
+        if self.state == 'half_open':
+            self.state = 'closed'
+            self._probe_in_flight = False
+            self._results.clear()
+
+    # A timed-out call counts as a latency sample at the timeout it hit, so the adaptive
+    # timeout can grow when Gemini slows down instead of cutting off every call
+    def record_failure(self, latency=None):
+        if latency is not None:
+            self._latencies.append(latency)
+        self._results.append(False)
+        if self.state == 'half_open':
+            self._open()
+            return
+        if len(self._results) >= self.min_calls:
+            failures = self._results.count(False)
+            if failures / len(self._results) >= self.error_rate:
+                self._open()
+
+    # True while calls should skip Gemini entirely (does not use up the half-open probe)
+    def is_open(self):
+        return self.state == 'open' and time.monotonic() - self._opened_at < self.cooldown
+
+    def release_probe(self):
+        self._probe_in_flight = False
+
+    def _open(self):
+        self.state = 'open'
+        self._opened_at = time.monotonic()
+        self._probe_in_flight = False
+
+    def p99(self):
+        if len(self._latencies) < self.min_calls:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+
+    def timeout(self):
+        p99 = self.p99()
+        # The half-open probe gets the full timeout - a stale p99 would make it fail every time
+        if p99 is None or self.state == 'half_open':
+            return self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, p99 * self.timeout_multiplier))
+
+    def recent_error_rate(self):
+        if not self._results:
+            return 0.0
+        return self._results.count(False) / len(self._results)
+
+gemini_breaker = CircuitBreaker(GEMINI_BREAKER_WINDOW, GEMINI_BREAKER_MIN_CALLS, GEMINI_BREAKER_ERROR_RATE,
+                                GEMINI_BREAKER_COOLDOWN, GEMINI_MIN_READ_TIMEOUT, GEMINI_READ_TIMEOUT,
+                                GEMINI_TIMEOUT_MULTIPLIER)
+
+# Async Gemini client - pooled keep-alive connections, retries transient 429/5xx with backoff
+class GeminiClient:
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, api_url, api_key, connect_timeout, read_timeout, max_retries, max_connections, breaker):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.connect_timeout = connect_timeout
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.breaker = breaker
+        self._client = None
+        self.requests = 0
+        self.retries = 0
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+        return self._client
+
+    def _backoff(self, attempt, response=None):
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                return min(float(retry_after), 10.0)
+        return 0.5 * (2 ** attempt) + random.uniform(0, 0.25)
+
+    # Returns the generated text; raises on non-retryable errors, when retries run out
+    # or when the circuit is open
+    async def generate(self, prompt):
         payload = {
             "contents": [{
                 "parts": [{
-                    "text": f"{base_prompt} Generate {count} different messages. Keep them under 50 characters and make them casual."
+                    "text": prompt
                 }]
             }]
         }
+        client = self._get_client()
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                raise CircuitOpenError("Gemini circuit is open")
+            self.requests += 1
+            read_timeout = self.breaker.timeout()
+            timeout = httpx.Timeout(read_timeout, connect=self.connect_timeout)
+            started = time.monotonic()
+            try:
+                response = await client.post(self.api_url, params={"key": self.api_key}, json=payload, timeout=timeout)
+            except httpx.TransportError as e:
+                self.breaker.record_failure(read_timeout if isinstance(e, httpx.ReadTimeout) else None)
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            except asyncio.CancelledError:
+                self.breaker.release_probe()
+                raise
+            except Exception:
+                # Anything else (decoding errors, too many redirects...) still counts against the
+                # circuit, and must not leave a half-open probe marked in flight forever
+                self.breaker.record_failure()
+                raise
+
+            if response.is_success:
+                self.breaker.record_success(time.monotonic() - started)
+                data = response.json()
+                return data['candidates'][0]['content']['parts'][0]['text'].strip()
+
+            self.breaker.record_failure()
+            if response.status_code in self.RETRY_STATUSES and attempt < self.max_retries:
+                self.retries += 1
+                await asyncio.sleep(self._backoff(attempt, response))
+                continue
+            response.raise_for_status()
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+gemini_client = GeminiClient(GEMINI_API_URL, GEMINI_API_KEY, GEMINI_CONNECT_TIMEOUT, GEMINI_READ_TIMEOUT,
+                             GEMINI_MAX_RETRIES, GEMINI_MAX_CONNECTIONS, gemini_breaker)
+
+# Fetch messages from Gemini - returns only real generated lines (may be fewer than count), raises on errors
+async def fetch_gemini_messages(language, count):
+    language_prompts = {
+        'english': 'Generate short, fun anonymous messages in English only.',
+        'hindi': 'Generate short, fun anonymous messages in Hindi only.',
+        'nepali': 'Generate short, fun anonymous messages in Nepali only.', 
+        'russian': 'Generate short, fun anonymous messages in Russian only.',
+        'hinglish': 'Generate short, fun anonymous messages in Hinglish only.'
+    }
+
+    base_prompt = language_prompts.get(language, language_prompts['english'])
+    prompt = f"{base_prompt} Generate {count} different messages. Keep them under 50 characters and make them casual."
+
+    full_text = await gemini_client.generate(prompt)
+    # Split the response into individual messages
+    messages = [msg.strip() for msg in full_text.split('\n') if msg.strip()]
+    return messages[:count]
+
+# Request coalescing - concurrent requests for the same language within a short window
+# share one upstream call for the combined count, and the returned lines are split between them
+class RequestCoalescer:
+    def __init__(self, fetch, window_ms):
+        self.fetch = fetch
+        self.window = window_ms / 1000
+        self._pending = {}  # language -> [(count, future)]
+        self._tasks = set()
+        self.requests = 0
+        self.upstream_calls = 0
+
+    async def request(self, language, count):
+        self.requests += 1
+        batch = self._pending.get(language)
+        if batch is None:
+            batch = []
+            self._pending[language] = batch
+            task = asyncio.create_task(self._dispatch(language))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        future = asyncio.get_running_loop().create_future()
+        batch.append((count, future))
+        return await future
+
+    async def _dispatch(self, language):
+        await asyncio.sleep(self.window)
+        batch = self._pending.pop(language)
+        self.upstream_calls += 1
+        try:
+            lines = await self.fetch(language, sum(count for count, _ in batch))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
 
-        headers = {
-            "Content-Type": "application/json"
-        }
+        # Deduplicate, then hand each waiter its own slice
+        lines = list(dict.fromkeys(lines))
+        start = 0
+        for count, future in batch:
+            if not future.done():
+                future.set_result(lines[start:start + count])
+            start += count
 
-        response = requests.post(url, json=payload, headers=headers, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            full_text = data['candidates'][0]['content']['parts'][0]['text'].strip()
-            # Split the response into individual messages
-            messages = [msg.strip() for msg in full_text.split('\n') if msg.strip()]
-            # If we got fewer messages than requested, generate the rest
-            while len(messages) < count:
-                messages.append(f"Fun message #{random.randint(1000,9999)}")
-            return messages[:count]
-        else:
-            return [f"Fun message #{random.randint(1000,9999)}" for _ in range(count)]
+    def coalesced(self):
+        return self.requests - self.upstream_calls
+
+gemini_coalescer = RequestCoalescer(fetch_gemini_messages, AI_COALESCE_WINDOW_MS)
+
+# Generate message with Gemini API - falls back to offline messages without waiting.
+# Messages in `exclude` (e.g. ones the user has already been shown) are never returned.
+async def generate_gemini_message(language="english", count=1, exclude=()):
+    if AI_MODE == 'local' or gemini_breaker.is_open():
+        return offline_messages(language, count, exclude=exclude)
+    try:
+        messages = await gemini_coalescer.request(language, count)
     except Exception as e:
-        return [f"Random message {random.randint(1000,9999)}" for _ in range(count)]
+        return offline_messages(language, count, exclude=exclude)
+    messages = [message for message in messages if message not in exclude]
+
+    # If we got fewer messages than requested, fill up offline
+    if len(messages) < count:
+        messages += offline_messages(language, count - len(messages), exclude=set(exclude) | set(messages))
+    return messages[:count]
+
+# Per-language pool of ready AI messages, topped up in the background
+class MessagePool:
+    def __init__(self, size, refill_threshold, refill_batch):
+        self.size = size
+        self.refill_threshold = refill_threshold
+        self.refill_batch = refill_batch
+        self._pools = {language: deque() for language in LANGUAGES}
+        self._members = {language: set() for language in LANGUAGES}
+        self._wakeup = None
+        self.hits = {language: 0 for language in LANGUAGES}
+        self.misses = {language: 0 for language in LANGUAGES}
+        self.refills = {language: 0 for language in LANGUAGES}
+
+    def add(self, language, messages):
+        pool = self._pools[language]
+        members = self._members[language]
+        added = 0
+        for message in messages:
+            if len(pool) >= self.size:
+                break
+            if message not in members:
+                pool.append(message)
+                members.add(message)
+                added += 1
+        return added
+
+    # Take up to count messages the user hasn't seen; seen ones stay in the pool for others
+    def take(self, language, count, seen):
+        pool = self._pools[language]
+        members = self._members[language]
+        taken = []
+        skipped = []
+        while pool and len(taken) < count:
+            message = pool.popleft()
+            if message in seen:
+                skipped.append(message)
+            else:
+                members.discard(message)
+                taken.append(message)
+        pool.extendleft(reversed(skipped))
+        if len(pool) < self.refill_threshold:
+            self.request_refill()
+        return taken
+
+    async def get(self, language, count, seen):
+        if language not in self._pools:
+            language = 'english'
+        messages = self.take(language, count, seen)
+        if len(messages) == count:
+            self.hits[language] += 1
+            return messages
+
+        # Pool ran dry - generate the rest directly
+        self.misses[language] += 1
+        extra = await generate_gemini_message(language=language, count=count - len(messages),
+                                              exclude=set(seen) | set(messages))
+        return messages + extra
+
+    def request_refill(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _refill_language(self, language):
+        pool = self._pools[language]
+        if len(pool) >= self.refill_threshold:
+            return
+        while len(pool) < self.size:
+            try:
+                generated = await gemini_coalescer.request(language, self.refill_batch)
+            except CircuitOpenError:
+                return
+            except Exception as e:
+                print(f"AI pool refill error ({language}): {e}")
+                return
+            self.refills[language] += 1
+            if not self.add(language, generated):
+                return
+
+    async def refill(self):
+        await asyncio.gather(*(self._refill_language(language) for language in LANGUAGES))
+
+    async def run(self, interval):
+        self._wakeup = asyncio.Event()
+        while True:
+            await self.refill()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def sizes(self):
+        return {language: len(pool) for language, pool in self._pools.items()}
+
+ai_message_pool = MessagePool(AI_POOL_SIZE, AI_POOL_REFILL_THRESHOLD, AI_POOL_REFILL_BATCH)
+
+# Get AI messages for a user from the pool, never repeating ones this user has already been shown
+async def generate_ai_messages(session, language, count):
+    if session.seen_ai_messages is None:
+        session.seen_ai_messages = deque(maxlen=AI_SEEN_HISTORY)
+    seen = session.seen_ai_messages
+    if AI_MODE == 'local':
+        messages = offline_messages(language, count, exclude=set(seen))
+    else:
+        messages = await ai_message_pool.get(language, count, set(seen))
+    seen.extend(messages)
+    user_activity.count_ai_messages(language, len(messages))
+    return messages
 
 # Send message to NGL
+def ngl_username(ngl_link):
+    return ngl_link.replace('https://ngl.link/', '').split('?')[0].strip('/')
+
 def send_ngl_message(ngl_link, message):
     try:
-        username = ngl_link.replace('https://ngl.link/', '').split('?')[0]
+        username = ngl_username(ngl_link)
 
         payload = {
             "username": username,
@@ -215,27 +1393,369 @@ def send_ngl_message(ngl_link, message):
     except Exception as e:
         return False
 
-# Admin notification (only for non-admin users)
-async def notify_admin(context: ContextTypes.DEFAULT_TYPE, message: str, user_id: int):
+# Buffers routine admin notifications and sends them as one compact digest
+# every `interval` seconds, or sooner once `max_events` are waiting
+class AdminDigest:
+    def __init__(self, interval, max_events):
+        self.interval = interval
+        self.max_events = max_events
+        self._events = []
+        self._wakeup = asyncio.Event()
+        self.events = 0
+        self.digests = 0
+        self.messages_sent = 0
+
+    def add(self, text):
+        self._events.append((get_current_time(), text))
+        self.events += 1
+        if len(self._events) >= self.max_events:
+            self._wakeup.set()
+
+    def pending(self):
+        return len(self._events)
+
+    # Change the interval; 0 disables buffering (events are sent as they happen)
+    def set_interval(self, seconds):
+        self.interval = seconds
+        self._wakeup.set()
+
+    def _render(self, events):
+        lines = [
+            ' | '.join(line.strip() for line in text.strip().splitlines() if line.strip())
+            for _, text in events
+        ]
+        header = f"📬 Admin digest: {len(events)} events ({events[0][0].strftime('%H:%M')}–{events[-1][0].strftime('%H:%M')})\n"
+        chunks = [header]
+        for (event_time, _), line in zip(events, lines):
+            if len(line) > ADMIN_DIGEST_EVENT_CHARS:
+                line = line[:ADMIN_DIGEST_EVENT_CHARS - 1] + '…'
+            entry = f"\n[{event_time.strftime('%H:%M')}] {line}"
+            if len(chunks[-1]) + len(entry) > TELEGRAM_MESSAGE_LIMIT:
+                chunks.append('')
+            chunks[-1] += entry
+        return chunks
+
+    async def flush(self, bot):
+        if not self._events:
+            return
+        events, self._events = self._events, []
+        self.digests += 1
+        for chunk in self._render(events):
+            try:
+                await bot.send_message(chat_id=ADMIN_ID, text=chunk)
+                self.messages_sent += 1
+            except Exception as e:
+                print(f"Admin digest error: {e}")
+
+    async def run(self, bot):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval or None)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush(bot)
+
+admin_digest = AdminDigest(ADMIN_DIGEST_INTERVAL, ADMIN_DIGEST_MAX_EVENTS)
+
+# Admin event - routine events go into the digest, urgent ones (or all, with the digest off) are sent right away
+async def send_admin_event(bot, message, urgent=False):
     try:
-        if user_id != ADMIN_ID:  # Only notify if not admin
-            await context.bot.send_message(chat_id=ADMIN_ID, text=message)
+        if urgent or admin_digest.interval <= 0:
+            await bot.send_message(chat_id=ADMIN_ID, text=message)
+        else:
+            admin_digest.add(message)
     except Exception as e:
         print(f"Admin notify error: {e}")
 
-# Track message in database
+# Notify admin about a user's activity
+async def notify_admin(context: ContextTypes.DEFAULT_TYPE, message: str, user_id: int, urgent=False):
+    if user_id != ADMIN_ID:  # Only notify if not admin
+        await send_admin_event(context.bot, message, urgent)
+
+# Message log write-behind buffer - rows are flushed in one transaction per batch
+_message_log_buffer = []
+_message_log_lock = threading.Lock()
+_message_log_wakeup = None
+
+# Track message in database (buffered, flushed by message_log_writer)
 def track_message(user_id, ngl_link, message_text, status):
+    timestamp = epoch_seconds()
+    with _message_log_lock:
+        _message_log_buffer.append((user_id, ngl_link, message_text, status, timestamp))
+        batch_full = len(_message_log_buffer) >= MESSAGE_LOG_BATCH_SIZE
+    if batch_full and _message_log_wakeup is not None:
+        _message_log_wakeup.set()
+
+def flush_message_log():
+    global _message_log_buffer
+    with _message_log_lock:
+        rows, _message_log_buffer = _message_log_buffer, []
+    if not rows:
+        return []
     try:
-        conn = sqlite3.connect('ngl_bot.db')
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO messages (user_id, ngl_link, message_text, status) VALUES (?, ?, ?, ?)',
-            (user_id, ngl_link, message_text, status)
-        )
-        conn.commit()
-        conn.close()
+        conn = get_db()
+        with conn:
+            conn.executemany(
+                'INSERT INTO messages (user_id, ngl_link, message_text, status, timestamp) VALUES (?, ?, ?, ?, ?)',
+                rows
+            )
+            record_send_stats(conn, rows)
+        return rows
     except Exception as e:
         print(f"Database error: {e}")
+        # Put the rows back so the next flush retries them
+        with _message_log_lock:
+            _message_log_buffer[:0] = rows
+        return []
+
+# Background task: flush every MESSAGE_LOG_FLUSH_MS or as soon as a batch fills up
+async def message_log_writer():
+    global _message_log_wakeup
+    _message_log_wakeup = asyncio.Event()
+    while True:
+        try:
+            await asyncio.wait_for(_message_log_wakeup.wait(), timeout=MESSAGE_LOG_FLUSH_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        _message_log_wakeup.clear()
+        await flush_tracked_messages()
+
+# Flush the message log and drop the cached /track pages of every user whose rows were written.
+# Use this rather than flush_message_log directly from async code.
+async def flush_tracked_messages():
+    rows = await run_db(flush_message_log)
+    track_pages.invalidate({row[0] for row in rows})
+
+# One /track page of a user's messages, newest first, keyset-paginated on (timestamp, id).
+# cursor is the (timestamp, id) of the row the page starts after, going `direction`.
+# Returns (rows, has_newer, has_older); rows are (id, ngl_link, message_text, status, timestamp)
+def get_message_page(user_id, cursor=None, direction='older', limit=TRACK_PAGE_SIZE):
+    conn = get_db()
+    if direction == 'newer':
+        rows = conn.execute('''
+            SELECT id, ngl_link, message_text, status, timestamp
+            FROM messages
+            WHERE user_id = ? AND (timestamp, id) > (?, ?)
+            ORDER BY timestamp, id
+            LIMIT ?
+        ''', (user_id, cursor[0], cursor[1], limit + 1)).fetchall()
+        if len(rows) <= limit:
+            # Reached the newest rows - show the first page
+            return get_message_page(user_id, limit=limit)
+        return rows[limit - 1::-1], True, True
+
+    if cursor is None:
+        rows = conn.execute('''
+            SELECT id, ngl_link, message_text, status, timestamp
+            FROM messages
+            WHERE user_id = ?
+            ORDER BY timestamp DESC, id DESC
+            LIMIT ?
+        ''', (user_id, limit + 1)).fetchall()
+    else:
+        rows = conn.execute('''
+            SELECT id, ngl_link, message_text, status, timestamp
+            FROM messages
+            WHERE user_id = ? AND (timestamp, id) < (?, ?)
+            ORDER BY timestamp DESC, id DESC
+            LIMIT ?
+        ''', (user_id, cursor[0], cursor[1], limit + 1)).fetchall()
+    return rows[:limit], cursor is not None, len(rows) > limit
+
+# LRU cache of rendered /track pages, keyed by (user_id, direction, cursor).
+# A user's pages are dropped as soon as new rows for that user are written.
+class TrackPageCache:
+    def __init__(self, max_pages):
+        self.max_pages = max_pages
+        self._pages = OrderedDict()
+        self._keys_by_user = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        page = self._pages.get(key)
+        if page is None:
+            self.misses += 1
+            return None
+        self._pages.move_to_end(key)
+        self.hits += 1
+        return page
+
+    def put(self, key, page):
+        self._pages[key] = page
+        self._pages.move_to_end(key)
+        self._keys_by_user.setdefault(key[0], set()).add(key)
+        while len(self._pages) > self.max_pages:
+            old_key, _ = self._pages.popitem(last=False)
+            user_keys = self._keys_by_user.get(old_key[0])
+            user_keys.discard(old_key)
+            if not user_keys:
+                del self._keys_by_user[old_key[0]]
+
+    def invalidate(self, user_ids):
+        for user_id in user_ids:
+            for key in self._keys_by_user.pop(user_id, ()):
+                self._pages.pop(key, None)
+
+    def clear(self):
+        self._pages.clear()
+        self._keys_by_user.clear()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self):
+        return len(self._pages)
+
+track_pages = TrackPageCache(TRACK_CACHE_SIZE)
+
+# Membership storage helpers
+def load_memberships():
+    conn = get_db()
+    return conn.execute('SELECT chat_id, user_id, is_member, updated_at FROM memberships').fetchall()
+
+def save_memberships(rows):
+    conn = get_db()
+    with conn:
+        conn.executemany('''
+            INSERT OR REPLACE INTO memberships (chat_id, user_id, is_member, updated_at)
+            VALUES (?, ?, ?, ?)
+        ''', rows)
+
+def get_meta(key):
+    conn = get_db()
+    result = conn.execute('SELECT value FROM bot_meta WHERE key = ?', (key,)).fetchone()
+    return result[0] if result else None
+
+def set_meta(key, value):
+    conn = get_db()
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO bot_meta (key, value) VALUES (?, ?)', (key, value))
+
+def get_bot_user_ids():
+    conn = get_db()
+    return [row[0] for row in conn.execute('SELECT user_id FROM bot_users ORDER BY user_id')]
+
+def is_member_status(member):
+    return member.status in MEMBER_STATUSES or getattr(member, 'is_member', False)
+
+# Local membership table - kept current by chat_member updates, with get_chat_member as fallback.
+# For chats where the bot is admin (so it receives join/leave events) local entries never expire;
+# elsewhere they behave like a TTL cache.
+class MembershipCache:
+    def __init__(self, ttl, negative_ttl):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = {}  # user_id -> {chat_id: (is_member, updated_at)}
+        self.event_chats = set()
+        self.hits = 0
+        self.misses = 0
+        self.event_updates = 0
+
+    def load(self, rows):
+        for chat_id, user_id, is_member, updated_at in rows:
+            self._entries.setdefault(user_id, {})[chat_id] = (bool(is_member), updated_at)
+
+    def _is_fresh(self, chat_id, entry, now):
+        if entry is None:
+            return False
+        if chat_id in self.event_chats:
+            return True
+        ttl = self.ttl if entry[0] else self.negative_ttl
+        return now - entry[1] < ttl
+
+    def set_status(self, chat_id, user_id, is_member, now):
+        self._entries.setdefault(user_id, {})[chat_id] = (is_member, now)
+        return (chat_id, user_id, int(is_member), now)
+
+    async def get(self, bot, user_id, force_refresh=False):
+        chats = self._entries.get(user_id, {})
+        now = time.time()
+        stale = [chat_id for chat_id in (GROUP_ID, CHANNEL_ID)
+                 if force_refresh or not self._is_fresh(chat_id, chats.get(chat_id), now)]
+        if not stale:
+            self.hits += 1
+            return chats[GROUP_ID][0], chats[CHANNEL_ID][0]
+
+        # Look up every stale chat at the same time
+        self.misses += 1
+        members = await asyncio.gather(*(bot.get_chat_member(chat_id, user_id) for chat_id in stale))
+        rows = [self.set_status(chat_id, user_id, is_member_status(member), now) for chat_id, member in zip(stale, members)]
+        await run_db(save_memberships, rows)
+
+        chats = self._entries[user_id]
+        return chats[GROUP_ID][0], chats[CHANNEL_ID][0]
+
+    async def record_event(self, chat_id, user_id, is_member):
+        self.event_updates += 1
+        row = self.set_status(chat_id, user_id, is_member, time.time())
+        await run_db(save_memberships, [row])
+
+    def known(self, chat_id, user_id):
+        return chat_id in self._entries.get(user_id, {})
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+membership_cache = MembershipCache(MEMBERSHIP_TTL_SECONDS, MEMBERSHIP_NEGATIVE_TTL_SECONDS)
+
+# Map a chat from an update to our configured GROUP_ID / CHANNEL_ID
+def tracked_chat_id(chat):
+    if not chat.username:
+        return None
+    for chat_id in (GROUP_ID, CHANNEL_ID):
+        if chat_id[1:].lower() == chat.username.lower():
+            return chat_id
+    return None
+
+# chat_member updates - keep the local membership table current
+async def handle_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_member = update.chat_member
+    chat_id = tracked_chat_id(chat_member.chat)
+    if not chat_id:
+        return
+    new_member = chat_member.new_chat_member
+    await membership_cache.record_event(chat_id, new_member.user.id, is_member_status(new_member))
+
+# Find out which chats will send us chat_member updates (the bot has to be an admin there)
+async def detect_event_chats(bot):
+    for chat_id in (GROUP_ID, CHANNEL_ID):
+        try:
+            bot_member = await bot.get_chat_member(chat_id, bot.id)
+            if bot_member.status == 'administrator':
+                membership_cache.event_chats.add(chat_id)
+            else:
+                print(f"Bot is not admin in {chat_id} - membership falls back to TTL cache")
+        except Exception as e:
+            print(f"Membership event check error for {chat_id}: {e}")
+
+# One-time backfill of the local table for users we have never seen in a chat
+async def backfill_memberships(bot):
+    for chat_id in membership_cache.event_chats:
+        meta_key = f"membership_backfill:{chat_id}"
+        if await run_db(get_meta, meta_key):
+            continue
+        user_ids = await run_db(get_bot_user_ids)
+        rows = []
+        for user_id in user_ids:
+            if membership_cache.known(chat_id, user_id):
+                continue
+            try:
+                member = await bot.get_chat_member(chat_id, user_id)
+                rows.append(membership_cache.set_status(chat_id, user_id, is_member_status(member), time.time()))
+            except Exception as e:
+                print(f"Membership backfill error for {user_id}: {e}")
+            if len(rows) >= 100:
+                await run_db(save_memberships, rows)
+                rows = []
+            await asyncio.sleep(MEMBERSHIP_BACKFILL_DELAY)
+        if rows:
+            await run_db(save_memberships, rows)
+        await run_db(set_meta, meta_key, get_current_time().isoformat())
+        print(f"Membership backfill done for {chat_id} ({len(user_ids)} users)")
 
 # Check if user is member of group and channel
 async def check_membership(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id=None):
@@ -246,15 +1766,11 @@ async def check_membership(update: Update, context: ContextTypes.DEFAULT_TYPE, u
             user_id = update.effective_user.id
     
     try:
-        # Check group membership
-        member_group = await context.bot.get_chat_member(GROUP_ID, user_id)
-        is_member_group = member_group.status in ['member', 'administrator', 'creator']
-        
-        # Check channel membership
-        member_channel = await context.bot.get_chat_member(CHANNEL_ID, user_id)
-        is_member_channel = member_channel.status in ['member', 'administrator', 'creator']
+        # The "Check" button always asks Telegram again
+        is_member_group, is_member_channel = await membership_cache.get(context.bot, user_id, force_refresh=True)
         
         if is_member_group and is_member_channel:
+            user_activity.mark_verified(user_id)
             # User is member of both - send thanks message
             if hasattr(update, 'callback_query'):
                 await update.callback_query.edit_message_text(
@@ -309,14 +1825,9 @@ async def check_membership_before_send(user_id: int, context: ContextTypes.DEFAU
         return True  # Admin bypasses membership check
     
     try:
-        # Check group membership
-        member_group = await context.bot.get_chat_member(GROUP_ID, user_id)
-        is_member_group = member_group.status in ['member', 'administrator', 'creator']
-        
-        # Check channel membership
-        member_channel = await context.bot.get_chat_member(CHANNEL_ID, user_id)
-        is_member_channel = member_channel.status in ['member', 'administrator', 'creator']
-        
+        is_member_group, is_member_channel = await membership_cache.get(context.bot, user_id)
+        if is_member_group and is_member_channel:
+            user_activity.mark_verified(user_id)
         return is_member_group and is_member_channel
     except Exception as e:
         print(f"Membership check error: {e}")
@@ -329,7 +1840,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     first_name = update.effective_user.first_name
     
     # Track user in database
-    track_bot_user(user_id, username, first_name)
+    await run_db(track_bot_user, user_id, username, first_name)
     
     current_time = get_current_time()
     welcome_text = f"""
@@ -352,7 +1863,7 @@ Need help? Contact admin!
 """
 
     if user_id == ADMIN_ID:
-        welcome_text += "\n\n👑 Admin Commands:\n/broadcast - Broadcast message to all users"
+        welcome_text += "\n\n👑 Admin Commands:\n/broadcast [dryrun] [segment] [days] - Broadcast message to all users or a segment\n/pruned - Show or restore users pruned from broadcasts\n/metrics - Show cache and performance counters\n/digest [seconds|off|now] - Admin notification digest interval\n/stats [days|rebuild] - Daily usage stats\n/export <messages|users> [csv|jsonl] [filters] - Export data as a gzipped file\n/retention [days] [dryrun] - Archive old messages and reclaim space"
 
     await update.message.reply_text(welcome_text)
     
@@ -371,6 +1882,25 @@ Need help? Contact admin!
             reply_markup=reply_markup
         )
 
+def describe_segment(segment, days=None):
+    return BROADCAST_SEGMENTS[segment][1].format(days=days)
+
+# Parse "/broadcast [dryrun] [segment] [days]" arguments
+def parse_broadcast_args(args):
+    args = [arg.lower() for arg in args]
+    dry_run = bool(args) and args[0] == 'dryrun'
+    if dry_run:
+        args = args[1:]
+    segment = args[0] if args else 'all'
+    if segment not in BROADCAST_SEGMENTS:
+        raise ValueError(f"Unknown segment '{segment}'")
+    days = None
+    if segment in SEGMENTS_WITH_DAYS:
+        days = int(args[1]) if len(args) > 1 else 7
+        if days < 1:
+            raise ValueError("Days must be at least 1")
+    return dry_run, segment, days
+
 # Broadcast command (admin only)
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -379,6 +1909,24 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ This command is for admin only!")
         return
 
+    try:
+        dry_run, segment, days = parse_broadcast_args(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(
+            f"❌ {e}\n\nUsage: /broadcast [dryrun] [segment] [days]\n"
+            "Segments: all, joined <days>, active <days>, senders, unverified"
+        )
+        return
+
+    since = epoch_seconds(days) if segment in SEGMENTS_WITH_DAYS else None
+    recipient_count = await run_db(count_broadcast_recipients, segment, since)
+    target_text = f"🎯 Target: {describe_segment(segment, days)}\n👥 Recipients: {recipient_count}"
+
+    if dry_run:
+        await update.message.reply_text(f"🧪 Dry run - nothing will be sent.\n\n{target_text}")
+        return
+
+    get_session(update.effective_user.id).broadcast_segment = (segment, days)
     keyboard = [
         [InlineKeyboardButton("📝 Text Message", callback_data="broadcast_text")],
         [InlineKeyboardButton("🖼️ Photo", callback_data="broadcast_photo")],
@@ -386,13 +1934,11 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("↩️ Forward Message", callback_data="broadcast_forward")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("📢 Choose broadcast type:", reply_markup=reply_markup)
+    await update.message.reply_text(f"{target_text}\n\n📢 Choose broadcast type:", reply_markup=reply_markup)
 
-# Handle broadcast callbacks
-async def handle_broadcast_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Handle broadcast callbacks (the query is already answered by handle_callback)
+async def handle_broadcast_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
     query = update.callback_query
-    await query.answer()
-
     data = query.data
     user_id = query.from_user.id
 
@@ -401,85 +1947,330 @@ async def handle_broadcast_callback(update: Update, context: ContextTypes.DEFAUL
         return
 
     if data == "broadcast_text":
-        context.user_data['broadcast_type'] = 'text'
+        session.broadcast_type = 'text'
+        session.state = STATE_AWAITING_BROADCAST
         await query.edit_message_text("📝 Please send the text message to broadcast:")
         
     elif data == "broadcast_photo":
-        context.user_data['broadcast_type'] = 'photo'
+        session.broadcast_type = 'photo'
+        session.state = STATE_AWAITING_BROADCAST
         await query.edit_message_text("🖼️ Please send the photo with caption (if any):")
         
     elif data == "broadcast_both":
-        context.user_data['broadcast_type'] = 'both'
+        session.broadcast_type = 'both'
+        session.state = STATE_AWAITING_BROADCAST
         await query.edit_message_text("📝 Please send the photo with caption:")
         
     elif data == "broadcast_forward":
-        context.user_data['broadcast_type'] = 'forward'
+        session.broadcast_type = 'forward'
+        session.state = STATE_AWAITING_BROADCAST
         await query.edit_message_text("↩️ Please forward the message you want to broadcast:")
 
-# Send broadcast to all users - FIXED VERSION
-async def send_broadcast(context: ContextTypes.DEFAULT_TYPE, broadcast_type, content=None, photo_file_id=None, forward_from_chat_id=None, forward_message_id=None):
-    try:
-        users = get_all_bot_users()
-        success_count = 0
-        failed_count = 0
-        
-        # Send initial status message
-        status_msg = await context.bot.send_message(chat_id=ADMIN_ID, text=f"📢 Starting broadcast to {len(users)} users...")
-        
-        for user_id in users:
+# Progress reporter - coalesces status-message edits to at most one per interval, skips unchanged
+# text and always delivers the final text (through final_edit when given, e.g. to drop buttons)
+class ProgressReporter:
+    total_updates = 0
+    total_edits = 0
+
+    def __init__(self, edit, interval, final_edit=None):
+        self.edit = edit
+        self.final_edit = final_edit or edit
+        self.interval = interval
+        self._last_text = None
+        self._last_edit_at = 0.0
+        self._pending_text = None
+        self._flush_task = None
+        self._flushing = False
+
+    async def _send(self, text, edit=None):
+        self._last_text = text
+        self._last_edit_at = time.monotonic()
+        ProgressReporter.total_edits += 1
+        try:
+            await (edit or self.edit)(text)
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                print(f"Progress update error: {e}")
+        except Exception as e:
+            print(f"Progress update error: {e}")
+
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        if self._pending_text is not None and self._pending_text != self._last_text:
+            text, self._pending_text = self._pending_text, None
+            self._flushing = True
             try:
-                if broadcast_type == 'text':
-                    await context.bot.send_message(chat_id=user_id, text=content)
-                elif broadcast_type == 'photo':
-                    await context.bot.send_photo(chat_id=user_id, photo=photo_file_id, caption=content)
-                elif broadcast_type == 'both':
-                    await context.bot.send_photo(chat_id=user_id, photo=photo_file_id, caption=content)
-                elif broadcast_type == 'forward':
-                    await context.bot.forward_message(
-                        chat_id=user_id, 
-                        from_chat_id=forward_from_chat_id, 
-                        message_id=forward_message_id
-                    )
-                
-                success_count += 1
-                await asyncio.sleep(0.1)  # Small delay to avoid rate limits
-                
-            except Exception as e:
-                failed_count += 1
-                print(f"Failed to send to {user_id}: {e}")
-        
-        # Update status message with results
-        await context.bot.edit_message_text(
+                await self._send(text)
+            finally:
+                self._flushing = False
+        # Cleared only once the edit has landed, so finish() can wait for it
+        if self._flush_task is asyncio.current_task():
+            self._flush_task = None
+
+    async def update(self, text):
+        ProgressReporter.total_updates += 1
+        if text == self._last_text:
+            return
+        wait = self._last_edit_at + self.interval - time.monotonic()
+        if wait <= 0 and self._flush_task is None:
+            self._pending_text = None
+            await self._send(text)
+            return
+        # Too soon - keep only the latest text and send it when the interval is up
+        self._pending_text = text
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later(max(wait, 0)))
+
+    async def finish(self, text):
+        ProgressReporter.total_updates += 1
+        task, self._flush_task = self._flush_task, None
+        if task is not None:
+            if self._flushing:
+                # An intermediate edit is on its way - let it land first so it can't overwrite the final text
+                await asyncio.gather(task, return_exceptions=True)
+            else:
+                task.cancel()
+        self._pending_text = None
+        if text != self._last_text:
+            await self._send(text, self.final_edit)
+
+    @classmethod
+    def suppressed(cls):
+        return cls.total_updates - cls.total_edits
+
+# Token bucket - spreads sends over time at `rate` per second; pause() stops everyone after a RetryAfter
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = None
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+# Minimum spacing between messages to the same chat
+class PerChatLimiter:
+    def __init__(self, interval):
+        self.interval = interval
+        self._next_allowed = {}
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        next_allowed = self._next_allowed.get(chat_id, 0.0)
+        self._next_allowed[chat_id] = max(now, next_allowed) + self.interval
+        if next_allowed > now:
+            await asyncio.sleep(next_allowed - now)
+        if len(self._next_allowed) > 10000:
+            self._next_allowed = {cid: t for cid, t in self._next_allowed.items() if t > now}
+
+# Errors that mean the recipient is gone for good (blocked the bot, deleted account, unknown chat)
+def dead_recipient_reason(error):
+    if isinstance(error, Forbidden):
+        return 'blocked'
+    if isinstance(error, BadRequest) and 'chat not found' in str(error).lower():
+        return 'chat_not_found'
+    return None
+
+def retry_after_seconds(error):
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+async def send_broadcast_message(bot, job, user_id):
+    broadcast_type = job['broadcast_type']
+    if broadcast_type == 'text':
+        await bot.send_message(chat_id=user_id, text=job['content'])
+    elif broadcast_type in ('photo', 'both'):
+        await bot.send_photo(chat_id=user_id, photo=job['photo_file_id'], caption=job['content'])
+    elif broadcast_type == 'forward':
+        await bot.forward_message(
+            chat_id=user_id, 
+            from_chat_id=job['from_chat_id'], 
+            message_id=job['message_id']
+        )
+
+# Broadcast engine - jobs run as background tasks, send concurrently within Telegram's limits and
+# persist their cursor after every chunk so an interrupted broadcast resumes where it stopped
+class BroadcastEngine:
+    def __init__(self, rate, per_chat_interval, concurrency, chunk_size):
+        self.global_bucket = TokenBucket(rate, rate)
+        self.chat_limiter = PerChatLimiter(per_chat_interval)
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self._tasks = {}
+        self.sent = 0
+        self.failed = 0
+        self.pruned = 0
+        self.retry_afters = 0
+
+    async def start(self, bot, broadcast_type, content=None, photo_file_id=None, from_chat_id=None, message_id=None,
+                    segment='all', days=None):
+        # The cutoff is fixed when the job is created so a resumed job targets the same users
+        since = epoch_seconds(days) if segment in SEGMENTS_WITH_DAYS else None
+        total = await run_db(count_broadcast_recipients, segment, since)
+        status_msg = await bot.send_message(
             chat_id=ADMIN_ID,
-            message_id=status_msg.message_id,
-            text=f"✅ Broadcast completed!\n\n• Successful: {success_count}\n• Failed: {failed_count}\n• Total: {len(users)}"
+            text=f"📢 Starting broadcast to {total} users ({describe_segment(segment, days)})..."
+        )
+        job_id = await run_db(create_broadcast_job, broadcast_type, content, photo_file_id, from_chat_id,
+                              message_id, status_msg.message_id, total, segment, since)
+        self._launch(bot, job_id)
+        return job_id
+
+    async def resume(self, bot):
+        for job in await run_db(get_broadcast_jobs, 'running'):
+            print(f"Resuming broadcast #{job['id']} after user {job['cursor']}")
+            self._launch(bot, job['id'])
+
+    def _launch(self, bot, job_id):
+        task = asyncio.create_task(self._run(bot, job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    def active_jobs(self):
+        return len(self._tasks)
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, bot, job_id):
+        job = await run_db(get_broadcast_job, job_id)
+        cursor = job['cursor']
+        success_count = job['success_count']
+        failed_count = job['failed_count']
+        pruned_count = job['pruned_count']
+        semaphore = asyncio.Semaphore(self.concurrency)
+        progress = ProgressReporter(
+            lambda text: bot.edit_message_text(chat_id=ADMIN_ID, message_id=job['status_message_id'], text=text),
+            PROGRESS_UPDATE_INTERVAL
+        )
+        try:
+            while True:
+                recipients = await run_db(get_broadcast_recipients, cursor, self.chunk_size,
+                                          job['segment'] or 'all', job['segment_since'])
+                if not recipients:
+                    break
+                results = await asyncio.gather(*(self._deliver(bot, job, user_id, semaphore) for user_id in recipients))
+                dead = {}
+                for user_id, result in zip(recipients, results):
+                    if result == 'sent':
+                        success_count += 1
+                    else:
+                        failed_count += 1
+                        if result != 'failed':
+                            dead.setdefault(result, []).append(user_id)
+                for reason, user_ids in dead.items():
+                    await run_db(mark_users_inactive, user_ids, reason)
+                    pruned_count += len(user_ids)
+                cursor = recipients[-1]
+                await run_db(update_broadcast_progress, job_id, cursor, success_count, failed_count, pruned_count)
+                await progress.update(
+                    f"📢 Broadcasting... ({success_count + failed_count}/{job['total']})\n\n"
+                    f"• Successful: {success_count}\n• Failed: {failed_count}"
+                )
+
+            await run_db(finish_broadcast_job, job_id, 'done')
+            await progress.finish(
+                f"✅ Broadcast completed!\n\n• Successful: {success_count}\n• Failed: {failed_count}\n"
+                f"• Pruned (blocked/deleted): {pruned_count}\n• Total: {success_count + failed_count}"
+            )
+        except asyncio.CancelledError:
+            # Left as 'running' so it resumes on the next start
+            raise
+        except Exception as e:
+            await run_db(finish_broadcast_job, job_id, 'failed')
+            await bot.send_message(chat_id=ADMIN_ID, text=f"❌ Broadcast failed: {e}")
+
+    async def _deliver(self, bot, job, user_id, semaphore):
+        async with semaphore:
+            for attempt in range(BROADCAST_MAX_ATTEMPTS):
+                await self.chat_limiter.acquire(user_id)
+                await self.global_bucket.acquire()
+                try:
+                    await send_broadcast_message(bot, job, user_id)
+                    self.sent += 1
+                    return 'sent'
+                except RetryAfter as e:
+                    # Flood control applies to the whole bot, so every worker waits
+                    self.retry_afters += 1
+                    self.global_bucket.pause(retry_after_seconds(e))
+                except Exception as e:
+                    reason = dead_recipient_reason(e)
+                    if reason:
+                        self.pruned += 1
+                        self.failed += 1
+                        return reason
+                    print(f"Failed to send to {user_id}: {e}")
+                    break
+            self.failed += 1
+            return 'failed'
+
+broadcast_engine = BroadcastEngine(BROADCAST_RATE, BROADCAST_PER_CHAT_INTERVAL, BROADCAST_CONCURRENCY, BROADCAST_CHUNK_SIZE)
+
+# Start a broadcast in the background - the admin gets control back right away
+async def send_broadcast(context: ContextTypes.DEFAULT_TYPE, session, broadcast_type, content=None, photo_file_id=None, forward_from_chat_id=None, forward_message_id=None):
+    segment, days = session.broadcast_segment or ('all', None)
+    session.broadcast_segment = None
+    try:
+        await broadcast_engine.start(
+            context.bot,
+            broadcast_type,
+            content=content,
+            photo_file_id=photo_file_id,
+            from_chat_id=forward_from_chat_id,
+            message_id=forward_message_id,
+            segment=segment,
+            days=days
         )
-        
     except Exception as e:
         await context.bot.send_message(chat_id=ADMIN_ID, text=f"❌ Broadcast failed: {e}")
 
 # Handle broadcast content - FIXED VERSION
-async def handle_broadcast_content(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_broadcast_content(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
     user_id = update.effective_user.id
     
     if user_id != ADMIN_ID:
         await update.message.reply_text("❌ This command is for admin only!")
         return
 
-    broadcast_type = context.user_data.get('broadcast_type')
+    broadcast_type = session.broadcast_type
     
     if not broadcast_type:
         return
 
     try:
         if broadcast_type == 'text':
-            await send_broadcast(context, 'text', content=update.message.text)
+            await send_broadcast(context, session, 'text', content=update.message.text)
             
         elif broadcast_type == 'photo':
             if update.message.photo:
                 photo_file_id = update.message.photo[-1].file_id
                 caption = update.message.caption if update.message.caption else None
-                await send_broadcast(context, 'photo', content=caption, photo_file_id=photo_file_id)
+                await send_broadcast(context, session, 'photo', content=caption, photo_file_id=photo_file_id)
             else:
                 await update.message.reply_text("❌ Please send a photo.")
                 
@@ -487,7 +2278,7 @@ async def handle_broadcast_content(update: Update, context: ContextTypes.DEFAULT
             if update.message.photo:
                 photo_file_id = update.message.photo[-1].file_id
                 caption = update.message.caption if update.message.caption else None
-                await send_broadcast(context, 'both', content=caption, photo_file_id=photo_file_id)
+                await send_broadcast(context, session, 'both', content=caption, photo_file_id=photo_file_id)
             else:
                 await update.message.reply_text("❌ Please send a photo with caption.")
                 
@@ -495,17 +2286,53 @@ async def handle_broadcast_content(update: Update, context: ContextTypes.DEFAULT
             # SIMPLE FIX: Just forward the exact message that admin forwarded
             await send_broadcast(
                 context, 
+                session,
                 'forward', 
                 forward_from_chat_id=update.message.chat_id,
                 forward_message_id=update.message.message_id
             )
         
         # Clear broadcast data
-        context.user_data.pop('broadcast_type', None)
+        session.broadcast_type = None
+        session.state = STATE_IDLE
         
     except Exception as e:
         await update.message.reply_text(f"❌ Broadcast failed: {e}")
 
+# Conversation states - the state decides which handler gets the user's next text/photo
+STATE_IDLE = 'idle'
+STATE_AWAITING_LINK = 'awaiting_link'
+STATE_AWAITING_COUNT = 'awaiting_count'
+STATE_AWAITING_CUSTOM = 'awaiting_custom'
+STATE_AWAITING_BROADCAST = 'awaiting_broadcast'
+
+# Per-user conversation state (replaces the loose context.user_data flags)
+class Session:
+    __slots__ = ('state', 'ngl_link', 'message_type', 'language', 'message_count', 'custom_messages',
+                 'messages', 'batch_key', 'broadcast_type', 'broadcast_segment', 'seen_ai_messages')
+
+    def __init__(self):
+        self.state = STATE_IDLE
+        self.ngl_link = None
+        self.message_type = None
+        self.language = 'english'
+        self.message_count = 1
+        self.custom_messages = None
+        self.messages = None
+        self.batch_key = None
+        self.broadcast_type = None
+        self.broadcast_segment = None
+        self.seen_ai_messages = None
+
+# user_id -> Session
+sessions = {}
+
+def get_session(user_id):
+    session = sessions.get(user_id)
+    if session is None:
+        session = sessions[user_id] = Session()
+    return session
+
 # Send command handler
 async def send_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -531,26 +2358,10 @@ async def send_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Rate limit check for non-admin users
     if user_id != ADMIN_ID:
-        current_count = check_rate_limit(user_id)
-        remaining = 30 - current_count
-        if current_count >= 30:
-            # Get time remaining until reset
-            conn = sqlite3.connect('ngl_bot.db')
-            cursor = conn.cursor()
-            cursor.execute('SELECT last_reset FROM users WHERE user_id = ?', (user_id,))
-            result = cursor.fetchone()
-            conn.close()
-
-            if result:
-                last_reset = datetime.fromisoformat(result[0])
-                time_passed = get_current_time() - last_reset
-                time_remaining = timedelta(hours=24) - time_passed
-                hours_left = int(time_remaining.total_seconds() // 3600)
-                minutes_left = int((time_remaining.total_seconds() % 3600) // 60)
-
-                await update.message.reply_text(f"❌ Daily limit exceeded! You can only send 30 messages per 24 hours.\n\n⏰ Time remaining: {hours_left}h {minutes_left}m\n\nNeed help? Contact admin!")
-            else:
-                await update.message.reply_text("❌ Daily limit exceeded! You can only send 30 messages per 24 hours.\n\nNeed help? Contact admin!")
+        current_count = await rate_limiter.get_count(user_id)
+        remaining = DAILY_LIMIT - current_count
+        if current_count >= DAILY_LIMIT:
+            await update.message.reply_text(format_limit_exceeded(user_id))
             return
         else:
             await update.message.reply_text(f"📊 You have {remaining} messages remaining today.")
@@ -559,404 +2370,1407 @@ async def send_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text("Click below to start sending messages:", reply_markup=reply_markup)
 
-# Handle callback queries
-async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Callback handlers for the /send flow - one per button, dispatched through CALLBACK_HANDLERS
+async def on_enter_link(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
     query = update.callback_query
-    await query.answer()
-
-    data = query.data
     user_id = query.from_user.id
 
-    # Regular send flow
-    if data == "enter_link":
-        # Check membership for non-admin users before allowing to send
-        if user_id != ADMIN_ID:
-            is_member = await check_membership_before_send(user_id, context)
-            if not is_member:
-                keyboard = [
-                    [InlineKeyboardButton("🔗 @KiddingARENA", url=f"https://t.me/{CHANNEL_ID[1:]}")],
-                    [InlineKeyboardButton("🔗 @premiumlinkers", url=f"https://t.me/{GROUP_ID[1:]}")],
-                    [InlineKeyboardButton("✅ Check", callback_data="check_membership")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.edit_message_text(
-                    "❌ Access denied!\n\n"
-                    "👉 Please join both our channel and group to use this feature.\n"
-                    "Click the buttons below to join, then click 'Check' to verify.",
-                    reply_markup=reply_markup
-                )
-                return
-        
-        context.user_data['awaiting_link'] = True
-        await query.edit_message_text("Please send me the NGL link (e.g., https://ngl.link/username)")
+    # Check membership for non-admin users before allowing to send
+    if user_id != ADMIN_ID:
+        is_member = await check_membership_before_send(user_id, context)
+        if not is_member:
+            keyboard = [
+                [InlineKeyboardButton("🔗 @KiddingARENA", url=f"https://t.me/{CHANNEL_ID[1:]}")],
+                [InlineKeyboardButton("🔗 @premiumlinkers", url=f"https://t.me/{GROUP_ID[1:]}")],
+                [InlineKeyboardButton("✅ Check", callback_data="check_membership")]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            
+            await query.edit_message_text(
+                "❌ Access denied!\n\n"
+                "👉 Please join both our channel and group to use this feature.\n"
+                "Click the buttons below to join, then click 'Check' to verify.",
+                reply_markup=reply_markup
+            )
+            return
+
+    session.state = STATE_AWAITING_LINK
+    await query.edit_message_text("Please send me the NGL link (e.g., https://ngl.link/username)")
+
+async def on_check_membership(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    await check_membership(update, context, update.callback_query.from_user.id)
+
+async def on_message_type(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    session.state = STATE_IDLE
+    keyboard = [
+        [InlineKeyboardButton("🤖 AI Generated", callback_data="ai_message")],
+        [InlineKeyboardButton("✏️ Custom Message", callback_data="custom_message")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.callback_query.edit_message_text("Choose message type:", reply_markup=reply_markup)
+
+async def on_ai_message(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    session.message_type = 'ai'
+    keyboard = [
+        [InlineKeyboardButton("🇺🇸 English", callback_data="lang_english")],
+        [InlineKeyboardButton("🇮🇳 Hindi", callback_data="lang_hindi")],
+        [InlineKeyboardButton("🇳🇵 Nepali", callback_data="lang_nepali")],
+        [InlineKeyboardButton("🇷🇺 Russian", callback_data="lang_russian")],
+        [InlineKeyboardButton("🔀 Hinglish", callback_data="lang_hinglish")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.callback_query.edit_message_text("Choose language for AI messages:", reply_markup=reply_markup)
 
-    elif data == "check_membership":
-        await check_membership(update, context, user_id)
+async def on_language(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    query = update.callback_query
+    language = query.data.split("_")[1]
+    session.language = language
 
-    elif data == "message_type":
-        context.user_data['awaiting_link'] = False
+    if query.from_user.id == ADMIN_ID:
+        await query.edit_message_text("📝 How many AI messages to send?\n\nSend the number (1-200):")
+        session.state = STATE_AWAITING_COUNT
+    else:
         keyboard = [
-            [InlineKeyboardButton("🤖 AI Generated", callback_data="ai_message")],
-            [InlineKeyboardButton("✏️ Custom Message", callback_data="custom_message")]
+            [InlineKeyboardButton("1 Message", callback_data="count_1")],
+            [InlineKeyboardButton("2 Messages", callback_data="count_2")],
+            [InlineKeyboardButton("3 Messages", callback_data="count_3")],
+            [InlineKeyboardButton("4 Messages", callback_data="count_4")],
+            [InlineKeyboardButton("5 Messages", callback_data="count_5")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Choose message type:", reply_markup=reply_markup)
+        language_name = LANGUAGES.get(language, language)
+        await query.edit_message_text(f"Selected: {language_name}\nHow many messages to send?", reply_markup=reply_markup)
 
-    elif data == "ai_message":
-        context.user_data['message_type'] = 'ai'
+async def on_custom_message(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    query = update.callback_query
+    session.message_type = 'custom'
+    if query.from_user.id == ADMIN_ID:
+        await query.edit_message_text("📝 How many custom messages to send?\n\nSend the number (1-200):")
+        session.state = STATE_AWAITING_COUNT
+    else:
         keyboard = [
-            [InlineKeyboardButton("🇺🇸 English", callback_data="lang_english")],
-            [InlineKeyboardButton("🇮🇳 Hindi", callback_data="lang_hindi")],
-            [InlineKeyboardButton("🇳🇵 Nepali", callback_data="lang_nepali")],
-            [InlineKeyboardButton("🇷🇺 Russian", callback_data="lang_russian")],
-            [InlineKeyboardButton("🔀 Hinglish", callback_data="lang_hinglish")]
+            [InlineKeyboardButton("1 Message", callback_data="custom_1")],
+            [InlineKeyboardButton("2 Messages", callback_data="custom_2")],
+            [InlineKeyboardButton("3 Messages", callback_data="custom_3")],
+            [InlineKeyboardButton("4 Messages", callback_data="custom_4")],
+            [InlineKeyboardButton("5 Messages", callback_data="custom_5")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Choose language for AI messages:", reply_markup=reply_markup)
-
-    elif data.startswith("lang_"):
-        language = data.split("_")[1]
-        context.user_data['language'] = language
-
-        if user_id == ADMIN_ID:
-            await query.edit_message_text("📝 How many AI messages to send?\n\nSend the number (1-200):")
-            context.user_data['awaiting_count'] = True
-        else:
-            keyboard = [
-                [InlineKeyboardButton("1 Message", callback_data="count_1")],
-                [InlineKeyboardButton("2 Messages", callback_data="count_2")],
-                [InlineKeyboardButton("3 Messages", callback_data="count_3")],
-                [InlineKeyboardButton("4 Messages", callback_data="count_4")],
-                [InlineKeyboardButton("5 Messages", callback_data="count_5")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            language_name = LANGUAGES.get(language, language)
-            await query.edit_message_text(f"Selected: {language_name}\nHow many messages to send?", reply_markup=reply_markup)
-
-    elif data == "custom_message":
-        context.user_data['message_type'] = 'custom'
-        if user_id == ADMIN_ID:
-            await query.edit_message_text("📝 How many custom messages to send?\n\nSend the number (1-200):")
-            context.user_data['awaiting_count'] = True
-        else:
-            keyboard = [
-                [InlineKeyboardButton("1 Message", callback_data="custom_1")],
-                [InlineKeyboardButton("2 Messages", callback_data="custom_2")],
-                [InlineKeyboardButton("3 Messages", callback_data="custom_3")],
-                [InlineKeyboardButton("4 Messages", callback_data="custom_4")],
-                [InlineKeyboardButton("5 Messages", callback_data="custom_5")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("How many custom messages to send?", reply_markup=reply_markup)
+        await query.edit_message_text("How many custom messages to send?", reply_markup=reply_markup)
 
-    elif data.startswith("custom_"):
-        count = int(data.split("_")[1])
-        context.user_data['message_count'] = count
-        context.user_data['custom_messages'] = []
-        context.user_data['awaiting_custom'] = True
-        context.user_data['current_custom_index'] = 0
+async def on_custom_count(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    count = int(update.callback_query.data.split("_")[1])
+    session.message_count = count
+    session.custom_messages = []
+    session.state = STATE_AWAITING_CUSTOM
 
-        await query.edit_message_text(f"Please send your custom message 1/{count}:")
+    await update.callback_query.edit_message_text(f"Please send your custom message 1/{count}:")
 
-    elif data.startswith("count_"):
-        count = int(data.split("_")[1])
-        context.user_data['message_count'] = count
+async def on_ai_count(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    query = update.callback_query
+    user_id = query.from_user.id
+    count = int(query.data.split("_")[1])
+    session.message_count = count
 
-        if context.user_data.get('message_type') == 'ai':
-            language = context.user_data.get('language', 'english')
-            messages = generate_gemini_message(language=language, count=count)
-            context.user_data['messages'] = messages
+    if session.message_type == 'ai':
+        language = session.language
+        messages = await generate_ai_messages(session, language, count)
+        send_button = prepare_batch(session, messages)
 
-            # Forward AI messages to admin (only if not admin)
-            if user_id != ADMIN_ID:
-                admin_ai_msg = f"""
+        # Forward AI messages to admin (only if not admin)
+        if user_id != ADMIN_ID:
+            admin_ai_msg = f"""
 🤖 AI Messages Generated:
 User: @{query.from_user.username if query.from_user.username else 'N/A'} ({user_id})
 Language: {language}
 Count: {count}
 """
-                for i, msg in enumerate(messages):
-                    admin_ai_msg += f"\n{i+1}. {msg}"
+            for i, msg in enumerate(messages):
+                admin_ai_msg += f"\n{i+1}. {msg}"
 
-                await notify_admin(context, admin_ai_msg, user_id)
+            await notify_admin(context, admin_ai_msg, user_id)
 
-            message_text = "\n".join([f"{i+1}. {msg}" for i, msg in enumerate(messages)])
-            language_name = LANGUAGES.get(language, language)
+        message_text = "\n".join([f"{i+1}. {msg}" for i, msg in enumerate(messages)])
+        language_name = LANGUAGES.get(language, language)
 
-            keyboard = [
-                [InlineKeyboardButton("🔄 Regenerate All", callback_data="regenerate_all")],
-                [InlineKeyboardButton("🚀 Send Messages", callback_data="send_messages")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(f"Language: {language_name}\n\nGenerated messages:\n\n{message_text}", reply_markup=reply_markup)
+        keyboard = [
+            [InlineKeyboardButton("🔄 Regenerate All", callback_data="regenerate_all")],
+            [send_button]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await query.edit_message_text(f"Language: {language_name}\n\nGenerated messages:\n\n{message_text}", reply_markup=reply_markup)
 
-    elif data == "regenerate_all":
-        count = context.user_data.get('message_count', 1)
-        language = context.user_data.get('language', 'english')
-        messages = generate_gemini_message(language=language, count=count)
-        context.user_data['messages'] = messages
+async def on_regenerate_all(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    query = update.callback_query
+    user_id = query.from_user.id
+    count = session.message_count
+    language = session.language
+    messages = await generate_ai_messages(session, language, count)
+    send_button = prepare_batch(session, messages)
 
-        # Forward regenerated messages to admin (only if not admin)
-        if user_id != ADMIN_ID:
-            admin_regenerate_msg = f"""
+    # Forward regenerated messages to admin (only if not admin)
+    if user_id != ADMIN_ID:
+        admin_regenerate_msg = f"""
 🔄 AI Messages Regenerated:
 User: @{query.from_user.username if query.from_user.username else 'N/A'} ({query.from_user.id})
 Language: {language}
 Count: {count}
 """
-            for i, msg in enumerate(messages):
-                admin_regenerate_msg += f"\n{i+1}. {msg}"
+        for i, msg in enumerate(messages):
+            admin_regenerate_msg += f"\n{i+1}. {msg}"
 
-            await notify_admin(context, admin_regenerate_msg, user_id)
+        await notify_admin(context, admin_regenerate_msg, user_id)
 
-        message_text = "\n".join([f"{i+1}. {msg}" for i, msg in enumerate(messages)])
-        language_name = LANGUAGES.get(language, language)
-        keyboard = [
-            [InlineKeyboardButton("🔄 Regenerate All", callback_data="regenerate_all")],
-            [InlineKeyboardButton("🚀 Send Messages", callback_data="send_messages")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(f"Language: {language_name}\n\nRegenerated messages:\n\n{message_text}", reply_markup=reply_markup)
+    message_text = "\n".join([f"{i+1}. {msg}" for i, msg in enumerate(messages)])
+    language_name = LANGUAGES.get(language, language)
+    keyboard = [
+        [InlineKeyboardButton("🔄 Regenerate All", callback_data="regenerate_all")],
+        [send_button]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(f"Language: {language_name}\n\nRegenerated messages:\n\n{message_text}", reply_markup=reply_markup)
 
-    elif data == "send_messages":
-        await send_messages_process(update, context)
+# Older/Newer buttons on a /track page: track_older:<id>:<timestamp>, track_newer:<id>:<timestamp>
+async def on_track_page(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    query = update.callback_query
+    action, row_id, timestamp = query.data.split(":", 2)
+    direction = 'newer' if action == 'track_newer' else 'older'
+    track_text, reply_markup = await render_track_page(query.from_user.id, direction, (int(timestamp), int(row_id)))
+    await query.edit_message_text(track_text, reply_markup=reply_markup)
+
+async def on_send_messages(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    await send_messages_process(update, context, session)
+
+# Callback data -> handler. Exact matches first ("custom_message"), then the prefix before
+# the first "_" ("custom_3", "lang_hindi", "broadcast_text"); ":" separates a payload ("send_messages:<key>")
+CALLBACK_HANDLERS = {
+    'enter_link': on_enter_link,
+    'check_membership': on_check_membership,
+    'message_type': on_message_type,
+    'ai_message': on_ai_message,
+    'custom_message': on_custom_message,
+    'regenerate_all': on_regenerate_all,
+    'send_messages': on_send_messages,
+    'lang': on_language,
+    'custom': on_custom_count,
+    'count': on_ai_count,
+    'broadcast': handle_broadcast_callback,
+    'track': on_track_page,
+}
 
-    # Handle broadcast callbacks
-    elif data.startswith("broadcast_"):
-        await handle_broadcast_callback(update, context)
+def callback_handler_for(data):
+    handler = CALLBACK_HANDLERS.get(data.partition(":")[0])
+    if handler is None:
+        handler = CALLBACK_HANDLERS.get(data.partition("_")[0])
+    return handler
 
-# Handle text messages
-async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    text = update.message.text
+# Handle callback queries
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    user_id = query.from_user.id
+    session = get_session(user_id)
 
-    # Handle broadcast messages
-    if context.user_data.get('broadcast_type'):
-        await handle_broadcast_content(update, context)
+    # Batch controls answer with a popup instead of editing the progress message
+    if data == "batch_status":
+        batch = active_batches.get(user_id)
+        await query.answer(batch.status_text() if batch else "No batch running.", show_alert=True)
+        return
+    if data == "batch_cancel":
+        batch = active_batches.get(user_id)
+        if batch:
+            batch.cancel_requested.set()
+            await query.answer("🛑 Cancelling...")
+        else:
+            await query.answer("No batch running.")
         return
+    # Duplicate taps / redelivered callbacks for a prepared batch are answered from the dedupe store
+    claimed_key = None
+    if data.startswith("send_messages"):
+        batch_key = data.partition(":")[2] or session.batch_key
+        if not batch_key or batch_key != session.batch_key:
+            # Not the session's current batch - a finished one still answers from the store until it expires
+            previous = batch_dedupe.result(batch_key) if batch_key else None
+            if previous is None:
+                previous = ("This batch is outdated - use the latest Send button." if session.batch_key
+                            else "⌛ This batch has expired - use /send to prepare a new one.")
+        else:
+            previous = batch_dedupe.claim(batch_key)
+        if previous is not None:
+            if previous == BatchDedupe.IN_FLIGHT:
+                batch = active_batches.get(user_id)
+                previous = batch.status_text() if batch else "⏳ This batch is already being sent."
+            await query.answer(previous, show_alert=True)
+            return
+        claimed_key = batch_key
 
+    try:
+        await query.answer()
+
+        handler = callback_handler_for(data)
+        if handler:
+            await handler(update, context, session)
+    except Exception:
+        # A claimed batch that failed before launching must not stay in flight until the key expires
+        if claimed_key is not None:
+            batch = active_batches.get(user_id)
+            if batch is None or batch.batch_key != claimed_key or batch.task is None:
+                batch_dedupe.release(claimed_key)
+        raise
+
+# Text handlers for the states that wait on user input, dispatched through TEXT_HANDLERS
+async def on_count_text(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
     # Admin custom count input
-    if context.user_data.get('awaiting_count') and user_id == ADMIN_ID:
-        try:
-            count = int(text)
-            if count < 1 or count > 200:
-                await update.message.reply_text("❌ Please enter a number between 1 and 200:")
-                return
-                
-            context.user_data['message_count'] = count
-            context.user_data['awaiting_count'] = False
-
-            if context.user_data.get('message_type') == 'ai':
-                language = context.user_data.get('language', 'english')
-                messages = generate_gemini_message(language=language, count=count)
-                context.user_data['messages'] = messages
-
-                message_text = "\n".join([f"{i+1}. {msg}" for i, msg in enumerate(messages)])
-                language_name = LANGUAGES.get(language, language)
-
-                keyboard = [
-                    [InlineKeyboardButton("🔄 Regenerate All", callback_data="regenerate_all")],
-                    [InlineKeyboardButton("🚀 Send Messages", callback_data="send_messages")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await update.message.reply_text(f"Language: {language_name}\n\nGenerated messages:\n\n{message_text}", reply_markup=reply_markup)
-            else:
-                context.user_data['custom_messages'] = []
-                context.user_data['awaiting_custom'] = True
-                context.user_data['current_custom_index'] = 0
-                await update.message.reply_text(f"Please send your custom message 1/{count}:")
-        except ValueError:
-            await update.message.reply_text("❌ Please send a valid number (1-200):")
+    if update.effective_user.id != ADMIN_ID:
+        return
+    text = update.message.text
+    try:
+        count = int(text)
+        if count < 1 or count > 200:
+            await update.message.reply_text("❌ Please enter a number between 1 and 200:")
+            return
+            
+        session.message_count = count
+        session.state = STATE_IDLE
 
-    # Regular link input
-    elif context.user_data.get('awaiting_link'):
-        if text.startswith('https://ngl.link/'):
-            context.user_data['ngl_link'] = text
-            context.user_data['awaiting_link'] = False
+        if session.message_type == 'ai':
+            language = session.language
+            messages = await generate_ai_messages(session, language, count)
+            send_button = prepare_batch(session, messages)
+
+            message_text = "\n".join([f"{i+1}. {msg}" for i, msg in enumerate(messages)])
+            language_name = LANGUAGES.get(language, language)
 
             keyboard = [
-                [InlineKeyboardButton("🤖 AI Generated", callback_data="ai_message")],
-                [InlineKeyboardButton("✏️ Custom Message", callback_data="custom_message")]
+                [InlineKeyboardButton("🔄 Regenerate All", callback_data="regenerate_all")],
+                [send_button]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("Great! Now choose message type:", reply_markup=reply_markup)
+            await update.message.reply_text(f"Language: {language_name}\n\nGenerated messages:\n\n{message_text}", reply_markup=reply_markup)
         else:
-            await update.message.reply_text("❌ Invalid NGL link. Please send a valid link starting with https://ngl.link/")
+            session.custom_messages = []
+            session.state = STATE_AWAITING_CUSTOM
+            await update.message.reply_text(f"Please send your custom message 1/{count}:")
+    except (TypeError, ValueError):
+        await update.message.reply_text("❌ Please send a valid number (1-200):")
+
+async def on_link_text(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    # Regular link input
+    text = update.message.text
+    if text and text.startswith('https://ngl.link/'):
+        session.ngl_link = text
+        session.state = STATE_IDLE
+
+        keyboard = [
+            [InlineKeyboardButton("🤖 AI Generated", callback_data="ai_message")],
+            [InlineKeyboardButton("✏️ Custom Message", callback_data="custom_message")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await update.message.reply_text("Great! Now choose message type:", reply_markup=reply_markup)
+    else:
+        await update.message.reply_text("❌ Invalid NGL link. Please send a valid link starting with https://ngl.link/")
 
+async def on_custom_text(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
     # Custom messages input
-    elif context.user_data.get('awaiting_custom'):
-        # Forward custom message to admin (only if not admin)
-        if user_id != ADMIN_ID:
-            admin_custom_msg = f"""
+    user_id = update.effective_user.id
+    text = update.message.text
+    if not text:
+        return
+
+    # Forward custom message to admin (only if not admin)
+    if user_id != ADMIN_ID:
+        admin_custom_msg = f"""
 📝 Custom Message from User:
 User: @{update.effective_user.username if update.effective_user.username else 'N/A'} ({user_id})
-Message {context.user_data['current_custom_index'] + 1}/{context.user_data['message_count']}:
+Message {len(session.custom_messages) + 1}/{session.message_count}:
 {text}
 """
-            await notify_admin(context, admin_custom_msg, user_id)
+        await notify_admin(context, admin_custom_msg, user_id)
 
-        context.user_data['custom_messages'].append(text)
-        context.user_data['current_custom_index'] += 1
+    session.custom_messages.append(text)
 
-        remaining = context.user_data['message_count'] - len(context.user_data['custom_messages'])
+    remaining = session.message_count - len(session.custom_messages)
 
-        if remaining > 0:
-            await update.message.reply_text(f"✅ Message {len(context.user_data['custom_messages'])}/{context.user_data['message_count']} added!\n\nSend next message ({remaining} remaining):")
-        else:
-            context.user_data['awaiting_custom'] = False
-            context.user_data['messages'] = context.user_data['custom_messages']
+    if remaining > 0:
+        await update.message.reply_text(f"✅ Message {len(session.custom_messages)}/{session.message_count} added!\n\nSend next message ({remaining} remaining):")
+    else:
+        session.state = STATE_IDLE
+        send_button = prepare_batch(session, session.custom_messages)
 
-            message_text = "\n".join([f"{i+1}. {msg}" for i, msg in enumerate(context.user_data['messages'])])
-            keyboard = [[InlineKeyboardButton("🚀 Send Messages", callback_data="send_messages")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text(f"Your {len(context.user_data['messages'])} messages:\n\n{message_text}", reply_markup=reply_markup)
+        message_text = "\n".join([f"{i+1}. {msg}" for i, msg in enumerate(session.messages)])
+        keyboard = [[send_button]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await update.message.reply_text(f"Your {len(session.messages)} messages:\n\n{message_text}", reply_markup=reply_markup)
+
+# Conversation state -> handler for incoming text, photos and forwards
+TEXT_HANDLERS = {
+    STATE_AWAITING_BROADCAST: handle_broadcast_content,
+    STATE_AWAITING_COUNT: on_count_text,
+    STATE_AWAITING_LINK: on_link_text,
+    STATE_AWAITING_CUSTOM: on_custom_text,
+}
 
-# Send messages process
-async def send_messages_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Handle text messages
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    session = get_session(update.effective_user.id)
+    handler = TEXT_HANDLERS.get(session.state)
+    if handler:
+        await handler(update, context, session)
+
+# Recent outbound submissions, used to rebuild the link cap index at startup
+def get_recent_submissions(since):
+    conn = get_db()
+    cursor = conn.execute(
+        "SELECT ngl_link, timestamp FROM messages WHERE timestamp >= ? AND status != 'capped'",
+        (since,)
+    )
+    return cursor.fetchall()
+
+# Sliding-window cap per target NGL username - protects recipients from pile-ons by many senders
+class LinkCap:
+    def __init__(self, max_sends, window_seconds):
+        self.max_sends = max_sends
+        self.window_seconds = window_seconds
+        self._sends = {}  # username (lowercase) -> deque of send times
+        self._operations = 0
+        self.capped = 0
+
+    def load(self, rows):
+        loaded = {}
+        for ngl_link, sent_at in rows:
+            loaded.setdefault(ngl_username(ngl_link).lower(), []).append(sent_at)
+        self._sends = {username: deque(sorted(sends)) for username, sends in loaded.items()}
+
+    # Record a submission if the target is under its cap; returns False when capped
+    def try_acquire(self, ngl_link):
+        now = time.time()
+        username = ngl_username(ngl_link).lower()
+        sends = self._sends.setdefault(username, deque())
+        cutoff = now - self.window_seconds
+        while sends and sends[0] <= cutoff:
+            sends.popleft()
+
+        self._operations += 1
+        if self._operations % 1000 == 0:
+            self._sweep(cutoff)
+
+        if len(sends) >= self.max_sends:
+            self.capped += 1
+            return False
+        sends.append(now)
+        return True
+
+    def _sweep(self, cutoff):
+        for username in [name for name, sends in self._sends.items() if not sends or sends[-1] <= cutoff]:
+            del self._sends[username]
+
+    def tracked_links(self):
+        return len(self._sends)
+
+link_cap = LinkCap(LINK_CAP_MAX, LINK_CAP_WINDOW_SECONDS)
+
+# Idempotency store for send batches: key -> (stored_at, result), bounded and expiring
+class BatchDedupe:
+    IN_FLIGHT = ""
+
+    def __init__(self, max_keys, ttl_seconds):
+        self.max_keys = max_keys
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # oldest first
+        self.duplicates = 0
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl_seconds
+        while self._entries:
+            key, (stored_at, _) = next(iter(self._entries.items()))
+            if stored_at > cutoff and len(self._entries) <= self.max_keys:
+                break
+            del self._entries[key]
+
+    # Claim a key for a new run; returns None if claimed, otherwise the stored result
+    # (IN_FLIGHT while that batch is still sending)
+    def claim(self, key):
+        self._expire()
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.duplicates += 1
+            return entry[1]
+        self._entries[key] = (time.monotonic(), self.IN_FLIGHT)
+        self._expire()
+        return None
+
+    # Stored result of a key without claiming it (None if unknown or expired)
+    def result(self, key):
+        self._expire()
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self.duplicates += 1
+        return entry[1]
+
+    # Record the final result of a claimed key
+    def complete(self, key, result):
+        self._entries[key] = (time.monotonic(), result)
+        self._entries.move_to_end(key)
+        self._expire()
+
+    # Forget a key whose batch never started (e.g. rate limited), so it can be retried
+    def release(self, key):
+        self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+batch_dedupe = BatchDedupe(BATCH_DEDUPE_MAX_KEYS, BATCH_DEDUPE_TTL_SECONDS)
+
+# Store a prepared batch under a fresh idempotency key; the Send button carries the key
+def prepare_batch(session, messages):
+    batch_key = uuid.uuid4().hex[:16]
+    session.messages = messages
+    session.batch_key = batch_key
+    return InlineKeyboardButton("🚀 Send Messages", callback_data=f"send_messages:{batch_key}")
+
+# Send batches - each runs as a background job so other users' updates are never stalled
+class SendBatch:
+    def __init__(self, user_id, ngl_link, messages, batch_key=None):
+        self.user_id = user_id
+        self.batch_key = batch_key
+        self.ngl_link = ngl_link
+        self.messages = messages
+        self.success_count = 0
+        self.failed_count = 0
+        self.capped_count = 0
+        self.task = None
+        self.cancel_requested = asyncio.Event()
+
+    def status_text(self):
+        done = self.success_count + self.failed_count + self.capped_count
+        text = f"🔄 Sending... ({done}/{len(self.messages)})\n✅ {self.success_count}  ❌ {self.failed_count}"
+        if self.capped_count:
+            text += f"  ⛔ {self.capped_count}"
+        return text
+
+# user_id -> SendBatch (at most one active batch per user)
+active_batches = {}
+
+BATCH_CONTROLS = InlineKeyboardMarkup([[
+    InlineKeyboardButton("📊 Status", callback_data="batch_status"),
+    InlineKeyboardButton("🛑 Cancel", callback_data="batch_cancel")
+]])
+
+# Run blocking work (e.g. the NGL request) on a worker thread
+async def run_blocking(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, func, *args)
+
+# Send messages process - validates and reserves quota, then hands the batch to a background job
+async def send_messages_process(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
     query = update.callback_query
     user_id = query.from_user.id
 
-    ngl_link = context.user_data.get('ngl_link')
-    messages = context.user_data.get('messages', [])
+    ngl_link = session.ngl_link
+    messages = session.messages or []
+    batch_key = session.batch_key
 
     if not ngl_link or not messages:
+        batch_dedupe.release(batch_key)
         await query.edit_message_text("❌ Error: Missing data")
         return
 
+    if user_id in active_batches:
+        batch_dedupe.release(batch_key)
+        await query.edit_message_text(
+            "⏳ You already have a batch running. Wait for it to finish or cancel it first.",
+            reply_markup=BATCH_CONTROLS
+        )
+        return
+
     if user_id != ADMIN_ID:
-        current_count = check_rate_limit(user_id)
-        if current_count + len(messages) > 30:
-            # Get time remaining until reset
-            conn = sqlite3.connect('ngl_bot.db')
-            cursor = conn.cursor()
-            cursor.execute('SELECT last_reset FROM users WHERE user_id = ?', (user_id,))
-            result = cursor.fetchone()
-            conn.close()
-
-            if result:
-                last_reset = datetime.fromisoformat(result[0])
-                time_passed = get_current_time() - last_reset
-                time_remaining = timedelta(hours=24) - time_passed
-                hours_left = int(time_remaining.total_seconds() // 3600)
-                minutes_left = int((time_remaining.total_seconds() % 3600) // 60)
-
-                await query.edit_message_text(f"❌ Daily limit exceeded! You can only send 30 messages per 24 hours.\n\n⏰ Time remaining: {hours_left}h {minutes_left}m\n\nNeed help? Contact admin!")
-            else:
-                await query.edit_message_text("❌ Daily limit exceeded! You can only send 30 messages per 24 hours.\n\nNeed help? Contact admin!")
+        # Reserve quota up front; unused quota is refunded when the batch ends
+        allowed, current_count = await rate_limiter.reserve(user_id, len(messages))
+        if not allowed:
+            batch_dedupe.release(batch_key)
+            await query.edit_message_text(format_limit_exceeded(user_id))
             return
         elif current_count >= 20:
-            remaining = 30 - current_count
-            await query.edit_message_text(f"⚠️ You've sent {current_count} messages today. You have {remaining} messages remaining.\n\nSlow down! You can send up to 30 messages per 24 hours.\n\nNeed help? Contact admin!")
-
-    success_count = 0
-    failed_count = 0
-
-    status_message = await query.edit_message_text("🔄 Sending messages...")
+            remaining = DAILY_LIMIT - current_count
+            await query.edit_message_text(f"⚠️ You've sent {current_count} messages today. You have {remaining} messages remaining.\n\nSlow down! You can send up to {DAILY_LIMIT} messages per 24 hours.\n\nNeed help? Contact admin!")
 
-    for i, message in enumerate(messages):
-        if i > 0:
-            time.sleep(random.uniform(2, 5))
-
-        success = send_ngl_message(ngl_link, message)
-
-        status = "success" if success else "failed"
-        track_message(user_id, ngl_link, message, status)
+    batch = SendBatch(user_id, ngl_link, list(messages), batch_key)
+    active_batches[user_id] = batch
+    try:
+        status_message = await query.edit_message_text("🔄 Sending messages...", reply_markup=BATCH_CONTROLS)
+    except Exception:
+        del active_batches[user_id]
+        batch_dedupe.release(batch_key)
+        if user_id != ADMIN_ID:
+            rate_limiter.refund(user_id, len(messages))
+        raise
+    # A plain task rather than application.create_task: Application.stop() waits for those, so a
+    # long batch would hold up shutdown. on_stop cancels these instead.
+    batch.task = asyncio.create_task(
+        run_send_batch_job(batch, status_message, query.from_user.username, update, context)
+    )
+
+# Batch task wrapper - errors go to the registered error handler, as they would for a handler
+async def run_send_batch_job(batch, status_message, username, update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await run_send_batch(batch, status_message, username, context)
+    except Exception as e:
+        await context.application.process_error(update, e)
+
+async def run_send_batch(batch, status_message, username, context: ContextTypes.DEFAULT_TYPE):
+    user_id = batch.user_id
+    messages = batch.messages
+    progress = ProgressReporter(
+        lambda text: status_message.edit_text(text, reply_markup=BATCH_CONTROLS),
+        PROGRESS_UPDATE_INTERVAL,
+        final_edit=status_message.edit_text
+    )
+    cancelled = False
 
-        if success:
-            success_count += 1
-        else:
-            failed_count += 1
+    try:
+        for i, message in enumerate(messages):
+            if i > 0:
+                # Same pacing as before, but a cancel request ends the wait immediately
+                try:
+                    await asyncio.wait_for(batch.cancel_requested.wait(), timeout=random.uniform(2, 5))
+                except asyncio.TimeoutError:
+                    pass
+            if batch.cancel_requested.is_set():
+                cancelled = True
+                break
+
+            # Target is over its protective cap - drop without an outbound call
+            if not link_cap.try_acquire(batch.ngl_link):
+                track_message(user_id, batch.ngl_link, message, "capped")
+                batch.capped_count += 1
+                await progress.update(batch.status_text())
+                continue
+
+            success = await run_blocking(send_ngl_message, batch.ngl_link, message)
+
+            status = "success" if success else "failed"
+            track_message(user_id, batch.ngl_link, message, status)
+
+            if success:
+                batch.success_count += 1
+            else:
+                batch.failed_count += 1
+
+            await progress.update(batch.status_text())
+    except asyncio.CancelledError:
+        cancelled = True
+    finally:
+        active_batches.pop(user_id, None)
+        # A finished batch can't be sent again from the session, even after its dedupe entry expires
+        session = sessions.get(user_id)
+        if session is not None and session.batch_key == batch.batch_key:
+            session.batch_key = None
+            session.messages = None
+        # Failed and never-attempted messages don't count against the daily limit
+        if user_id != ADMIN_ID:
+            rate_limiter.refund(user_id, len(messages) - batch.success_count)
 
-        await status_message.edit_text(f"🔄 Sending... ({i+1}/{len(messages)})")
+    success_count = batch.success_count
+    failed_count = batch.failed_count
+    capped_text = f"• Capped (recipient is receiving too many messages): {batch.capped_count}\n" if batch.capped_count else ""
+    if cancelled:
+        result_text = f"""
+🛑 Batch cancelled!
 
-    if user_id != ADMIN_ID:
-        update_rate_limit(user_id, len(messages))
+📊 Results:
+• Successful: {success_count}
+• Failed: {failed_count}
+{capped_text}• Not sent: {len(messages) - success_count - failed_count - batch.capped_count}
 
-    result_text = f"""
+Use /track to see detailed status.
+"""
+    else:
+        result_text = f"""
 ✅ Messages Sent Complete!
 
 📊 Results:
 • Successful: {success_count}
 • Failed: {failed_count}
-• Total: {len(messages)}
+{capped_text}• Total: {len(messages)}
 
 Use /track to see detailed status.
 """
 
-    await status_message.edit_text(result_text)
+    if batch.batch_key:
+        batch_dedupe.complete(batch.batch_key, (
+            f"{'🛑 This batch was cancelled' if cancelled else '✅ This batch was already sent'}.\n"
+            f"Successful: {success_count}, failed: {failed_count}, capped: {batch.capped_count}"
+        ))
+    await progress.finish(result_text)
 
     # Notify admin only if not admin user
     if user_id != ADMIN_ID:
         current_time = get_current_time()
         admin_msg = f"""
-📨 Message Batch Completed:
-User: @{query.from_user.username if query.from_user.username else 'N/A'} ({user_id})
-Link: {ngl_link}
+📨 Message Batch {'Cancelled' if cancelled else 'Completed'}:
+User: @{username if username else 'N/A'} ({user_id})
+Link: {batch.ngl_link}
 Success: {success_count}/{len(messages)}
 Time: {current_time.strftime('%Y-%m-%d %H:%M:%S')}
 """
         await notify_admin(context, admin_msg, user_id)
 
+# Cancel every running batch (called from on_stop, while the bot can still edit the result messages)
+async def cancel_send_batches():
+    tasks = [batch.task for batch in active_batches.values() if batch.task]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# Pruned users command (admin only): /pruned, /pruned restore <user_id ...>, /pruned restore all
+async def pruned_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ This command is for admin only!")
+        return
+
+    args = context.args or []
+    if args and args[0] == 'restore':
+        if len(args) < 2:
+            await update.message.reply_text("Usage: /pruned restore <user_id ...> or /pruned restore all")
+            return
+        if args[1] == 'all':
+            restored = await run_db(restore_users)
+        else:
+            try:
+                user_ids = [int(arg) for arg in args[1:]]
+            except ValueError:
+                await update.message.reply_text("❌ User IDs must be numbers.")
+                return
+            restored = await run_db(restore_users, user_ids)
+        await update.message.reply_text(f"✅ Restored {restored} user(s) to broadcasts.")
+        return
+
+    total, users = await run_db(get_inactive_users, 20)
+    if not total:
+        await update.message.reply_text("✅ No pruned users.")
+        return
+
+    pruned_text = f"🚫 Pruned users: {total}\n\n"
+    for user_id, username, reason, inactive_at in users:
+        pruned_text += f"• {user_id} @{username if username else 'N/A'} - {reason} ({format_epoch(inactive_at)})\n"
+    if total > len(users):
+        pruned_text += f"\n...and {total - len(users)} more"
+    pruned_text += "\n\nRestore with /pruned restore <user_id> or /pruned restore all"
+    await update.message.reply_text(pruned_text)
+
+# Record user activity for every private-chat update (used by the "active" broadcast segment).
+# Group messages are skipped - chatting in the group is not using the bot.
+async def record_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user and update.effective_chat and update.effective_chat.type == 'private':
+        user_activity.touch(update.effective_user.id)
+
+# Metrics command (admin only)
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ This command is for admin only!")
+        return
+
+    metrics_text = f"""
+📈 Bot Metrics
+
+👥 Membership:
+• Local hits: {membership_cache.hits}
+• API lookups: {membership_cache.misses}
+• Hit rate: {membership_cache.hit_rate():.1%}
+• Join/leave events: {membership_cache.event_updates}
+• Event-fed chats: {', '.join(sorted(membership_cache.event_chats)) or 'none'}
+• TTL: {membership_cache.ttl}s (negative: {membership_cache.negative_ttl}s)
+
+🤖 AI mode: {AI_MODE} (local generator produced {local_generator.generated})
+
+🤖 AI message pool (size / hits / misses / refills):
+"""
+    pool_sizes = ai_message_pool.sizes()
+    for language in LANGUAGES:
+        metrics_text += (f"• {LANGUAGES[language]}: {pool_sizes[language]}/{ai_message_pool.size} / "
+                         f"{ai_message_pool.hits[language]} / {ai_message_pool.misses[language]} / "
+                         f"{ai_message_pool.refills[language]}\n")
+
+    metrics_text += f"""
+🔀 Gemini coalescing:
+• Requests: {gemini_coalescer.requests}
+• Upstream calls: {gemini_coalescer.upstream_calls}
+• Coalesced: {gemini_coalescer.coalesced()}
+• Upstream HTTP requests (incl. retries): {gemini_client.requests}
+
+📨 Send batches running: {len(active_batches)}
+📬 Admin digest: {admin_digest.events} events in {admin_digest.messages_sent} messages ({admin_digest.pending()} pending)
+🧯 Errors: {error_tracker.total} total, {error_tracker.alerts} alerted, {error_tracker.fingerprints()} fingerprints
+💬 Sessions: {len(sessions)} ({sum(1 for session in sessions.values() if session.state != STATE_IDLE)} waiting for input)
+📜 /track pages: {track_pages.hit_rate():.1%} cache hits ({len(track_pages)} cached)
+🔁 Duplicate send taps ignored: {batch_dedupe.duplicates} ({len(batch_dedupe)} keys stored)
+⛔ Link cap: {link_cap.capped} capped, {link_cap.tracked_links()} links tracked ({link_cap.max_sends}/{link_cap.window_seconds}s)
+
+📢 Broadcasts:
+• Active jobs: {broadcast_engine.active_jobs()}
+• Sent: {broadcast_engine.sent}
+• Failed: {broadcast_engine.failed}
+• Pruned: {broadcast_engine.pruned}
+• RetryAfter pauses: {broadcast_engine.retry_afters}
+
+✏️ Progress edits:
+• Updates: {ProgressReporter.total_updates}
+• Edits sent: {ProgressReporter.total_edits}
+• Suppressed: {ProgressReporter.suppressed()}
+
+⚡ Gemini circuit breaker:
+• State: {gemini_breaker.state}
+• Recent error rate: {gemini_breaker.recent_error_rate():.1%}
+• Observed p99: {f"{gemini_breaker.p99():.2f}s" if gemini_breaker.p99() is not None else 'n/a'}
+• Read timeout: {gemini_breaker.timeout():.2f}s
+• Rejected while open: {gemini_breaker.rejected}
+"""
+    await update.message.reply_text(metrics_text)
+
 # Track command
 async def track_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+    track_text, reply_markup = await render_track_page(update.effective_user.id)
+    await update.message.reply_text(track_text, reply_markup=reply_markup)
+
+# Render a /track page - the message list and buttons come from the page cache when possible
+async def render_track_page(user_id, direction='older', cursor=None):
+    key = (user_id, direction, cursor)
+    page = track_pages.get(key)
+    if page is None:
+        sent_messages, has_newer, has_older = await run_db(get_message_page, user_id, cursor, direction)
+        page = (format_track_rows(sent_messages), track_page_buttons(sent_messages, has_newer, has_older))
+        track_pages.put(key, page)
+
     current_time = get_current_time()
+    track_text = f"🕐 Current Time: {current_time.strftime('%Y/%m/%d-%I:%M-%p')}\n\n" + page[0]
+    return track_text, page[1]
+
+def format_track_rows(sent_messages):
+    if not sent_messages:
+        return "📭 No messages sent yet. Use /send to start sending messages."
+
+    track_text = "📊 Recent Sent Messages:\n\n"
+    for _, link, text, status, timestamp in sent_messages:
+        status_icon = "✅" if status == "success" else "⛔" if status == "capped" else "❌"
+        time_str = format_epoch(timestamp)
+        track_text += f"{status_icon} {time_str}\n"
+        track_text += f"Link: {link}\n"
+        track_text += f"Message: {text[:50]}...\n\n"
+    return track_text
+
+def track_page_buttons(sent_messages, has_newer, has_older):
+    buttons = []
+    if has_newer:
+        first = sent_messages[0]
+        buttons.append(InlineKeyboardButton("⬅️ Newer", callback_data=f"track_newer:{first[0]}:{first[4]}"))
+    if has_older:
+        last = sent_messages[-1]
+        buttons.append(InlineKeyboardButton("Older ➡️", callback_data=f"track_older:{last[0]}:{last[4]}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+# Admin exports - what can be exported and how each filter maps onto the table
+EXPORT_TABLES = {
+    'messages': {
+        'table': 'messages',
+        'columns': ('id', 'user_id', 'ngl_link', 'message_text', 'status', 'timestamp'),
+        'time_column': 'timestamp',
+        'time_columns': ('timestamp',),
+        'statuses': {status: ('status = ?', status) for status in ('success', 'failed', 'capped')},
+    },
+    'users': {
+        'table': 'bot_users',
+        'columns': ('user_id', 'username', 'first_name', 'joined_at', 'active', 'inactive_reason', 'inactive_at',
+                    'last_active_at', 'verified_at'),
+        'time_column': 'joined_at',
+        'time_columns': ('joined_at', 'inactive_at', 'last_active_at', 'verified_at'),
+        'statuses': {'active': ('active = ?', 1), 'inactive': ('active = ?', 0)},
+    },
+}
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+# /export <messages|users> [csv|jsonl] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [user=<id>] [status=<status>]
+# Returns (kind, fmt, filters) where filters holds epoch bounds, user_id and a status condition
+def parse_export_args(args):
+    if not args or args[0] not in EXPORT_TABLES:
+        raise ValueError(f"Choose what to export: {', '.join(EXPORT_TABLES)}")
+    kind = args[0]
+    fmt = 'csv'
+    filters = {}
+    for arg in args[1:]:
+        if arg in EXPORT_FORMATS:
+            fmt = arg
+            continue
+        key, _, value = arg.partition('=')
+        try:
+            if key in ('from', 'to'):
+                day = TIMEZONE.localize(datetime.strptime(value, '%Y-%m-%d'))
+                if key == 'to':
+                    day += timedelta(days=1)
+                filters[key] = int(day.timestamp())
+            elif key == 'user':
+                filters['user_id'] = int(value)
+            elif key == 'status' and value in EXPORT_TABLES[kind]['statuses']:
+                filters['status'] = EXPORT_TABLES[kind]['statuses'][value]
+            else:
+                raise ValueError
+        except ValueError:
+            raise ValueError(f"Unknown filter: {arg}")
+    return kind, fmt, filters
+
+def export_time(value):
+    return datetime.fromtimestamp(value, TIMEZONE).isoformat() if value is not None else None
+
+# Stream the filtered rows into a gzip file chunk by chunk - memory use doesn't depend on the row count.
+# Uses its own read-only connection, so a long export never ties up a DB worker or blocks writers (WAL).
+def write_export(path, kind, fmt, filters):
+    spec = EXPORT_TABLES[kind]
+    conditions, params = [], []
+    if 'from' in filters:
+        conditions.append(f"{spec['time_column']} >= ?")
+        params.append(filters['from'])
+    if 'to' in filters:
+        conditions.append(f"{spec['time_column']} < ?")
+        params.append(filters['to'])
+    if 'user_id' in filters:
+        conditions.append('user_id = ?')
+        params.append(filters['user_id'])
+    if 'status' in filters:
+        conditions.append(filters['status'][0])
+        params.append(filters['status'][1])
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+    columns = spec['columns']
+    time_indexes = [columns.index(column) for column in spec['time_columns']]
+
+    conn = sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True, timeout=30)
+    try:
+        # Ordered by the indexed time column, so no filter combination needs a sort pass
+        cursor = conn.execute(f"SELECT {', '.join(columns)} FROM {spec['table']}{where} ORDER BY {spec['time_column']}", params)
+        with gzip.open(path, 'wt', encoding='utf-8', newline='') as out:
+            writer = csv.writer(out) if fmt == 'csv' else None
+            if writer:
+                writer.writerow(columns)
+            total = 0
+            while True:
+                rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+                if not rows:
+                    break
+                for row in rows:
+                    row = list(row)
+                    for index in time_indexes:
+                        row[index] = export_time(row[index])
+                    if writer:
+                        writer.writerow(row)
+                    else:
+                        out.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n')
+                total += len(rows)
+        return total
+    finally:
+        conn.close()
+
+# Background export job - the file is built off the event loop and sent as a document
+async def run_export(bot, chat_id, kind, fmt, filters, description):
+    fd, path = tempfile.mkstemp(prefix='ngl_export_', suffix=f'.{fmt}.gz')
+    os.close(fd)
+    try:
+        await flush_tracked_messages()
+        started = time.monotonic()
+        total = await run_blocking(write_export, path, kind, fmt, filters)
+        size = os.path.getsize(path)
+        if size > EXPORT_MAX_BYTES:
+            await bot.send_message(
+                chat_id=chat_id,
+                text=f"❌ Export is {size / 1024 / 1024:.1f} MB compressed, over Telegram's 50 MB limit. Narrow it with from=/to=/user=/status=."
+            )
+            return
+        filename = f"{kind}_{get_current_time().strftime('%Y%m%d_%H%M%S')}.{fmt}.gz"
+        with open(path, 'rb') as document:
+            await bot.send_document(
+                chat_id=chat_id,
+                document=document,
+                filename=filename,
+                caption=f"📦 {description}\n{total} rows, {size / 1024:.1f} KB, built in {time.monotonic() - started:.1f}s"
+            )
+    except Exception as e:
+        await bot.send_message(chat_id=chat_id, text=f"❌ Export failed: {e}")
+    finally:
+        os.remove(path)
+
+# Export command (admin only) - see parse_export_args for the syntax
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ This command is for admin only!")
+        return
+
+    try:
+        kind, fmt, filters = parse_export_args(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(
+            f"❌ {e}\n\nUsage: /export <messages|users> [csv|jsonl] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [user=<id>] [status=<status>]\n"
+            "Statuses: success, failed, capped (messages); active, inactive (users)"
+        )
+        return
+
+    description = ' '.join(context.args)
+    await update.message.reply_text(f"⏳ Exporting {description} in the background...")
+    context.application.create_task(
+        run_export(context.bot, update.effective_chat.id, kind, fmt, filters, description),
+        update=update
+    )
+
+# Message retention - expired rows are written to a gzip JSONL archive, then deleted chunk by chunk.
+# Each chunk is archived and fsynced before its own short delete transaction, so senders are never
+# blocked for long and a crash can at worst archive a chunk twice, never lose it.
+ARCHIVE_COLUMNS = ('id', 'user_id', 'ngl_link', 'message_text', 'status', 'timestamp')
+
+# Epoch seconds of local midnight `days` days ago - retention only ever archives whole days,
+# so every day before the boundary has all of its rows archived
+def retention_cutoff(days):
+    day = get_current_time().date() - timedelta(days=days)
+    return int(TIMEZONE.localize(datetime.combine(day, datetime.min.time())).timestamp())
+
+# What a run would archive: (rows, oldest, newest, payload bytes)
+def retention_preview(cutoff):
+    conn = get_db()
+    return conn.execute('''
+        SELECT COUNT(*), MIN(timestamp), MAX(timestamp),
+               COALESCE(SUM(LENGTH(ngl_link) + LENGTH(message_text) + LENGTH(status)), 0)
+        FROM messages
+        WHERE timestamp < ?
+    ''', (cutoff,)).fetchone()
+
+# Database size as (page_size, page_count, freelist_count)
+def database_pages():
+    conn = get_db()
+    return tuple(conn.execute(f'PRAGMA {pragma}').fetchone()[0] for pragma in ('page_size', 'page_count', 'freelist_count'))
+
+# Record the boundary before deleting anything: /stats rebuild keeps the rollups of earlier days.
+# Per-user activity rows for those days are only needed by a rebuild, so they go too.
+def start_retention(boundary_day):
+    conn = get_db()
+    with conn:
+        row = conn.execute("SELECT value FROM bot_meta WHERE key = 'retention_boundary_day'").fetchone()
+        if row is None or row[0] < boundary_day:
+            conn.execute("INSERT OR REPLACE INTO bot_meta (key, value) VALUES ('retention_boundary_day', ?)", (boundary_day,))
+        conn.execute('DELETE FROM daily_active_users WHERE day < ?', (boundary_day,))
+
+class MessageArchive:
+    def __init__(self, path):
+        self.path = path
+        self._raw = None
+        self._out = None
+
+    def write_rows(self, rows):
+        if self._out is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._raw = open(self.path, 'ab')
+            self._out = io.TextIOWrapper(gzip.GzipFile(fileobj=self._raw, mode='wb'), encoding='utf-8', newline='')
+        for row in rows:
+            self._out.write(json.dumps(dict(zip(ARCHIVE_COLUMNS, row)), ensure_ascii=False) + '\n')
+        # Sync-flush the gzip stream and fsync, so the rows are on disk before they are deleted
+        self._out.flush()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+
+    def close(self):
+        if self._out is not None:
+            self._out.close()
+            self._raw.close()
+
+    def size(self):
+        return os.path.getsize(self.path) if self._out is not None else 0
+
+# Archive and delete one chunk of expired rows (oldest first); returns the number of rows moved
+def archive_message_chunk(archive, cutoff, limit):
+    conn = get_db()
+    rows = conn.execute(f'''
+        SELECT {', '.join(ARCHIVE_COLUMNS)}
+        FROM messages
+        WHERE timestamp < ?
+        ORDER BY timestamp
+        LIMIT ?
+    ''', (cutoff, limit)).fetchall()
+    if not rows:
+        return 0
+    archive.write_rows(rows)
+    with conn:
+        conn.executemany('DELETE FROM messages WHERE id = ?', [(row[0],) for row in rows])
+    return len(rows)
+
+# Hand up to `pages` free pages back to the filesystem; returns the pages still free
+def incremental_vacuum(pages):
+    conn = get_db()
+    # executescript steps the pragma to completion; execute() would free a single page per call
+    conn.executescript(f'PRAGMA incremental_vacuum({pages})')
+    return conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+def checkpoint_wal():
+    conn = get_db()
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+
+def format_bytes(size):
+    return f"{size / 1024 / 1024:.1f} MB" if abs(size) >= 1024 * 1024 else f"{size / 1024:.1f} KB"
+
+# Created on first use, inside the running event loop
+_retention_lock = None
+
+def retention_lock():
+    global _retention_lock
+    if _retention_lock is None:
+        _retention_lock = asyncio.Lock()
+    return _retention_lock
+
+# One retention pass over messages older than `days`; returns a report for the admin.
+# A dry run only counts what would be archived and how much free space the file already holds.
+async def run_retention(days, dry_run=False):
+    async with retention_lock():
+        cutoff = retention_cutoff(days)
+        boundary_day = stats_day(cutoff)
+        await flush_tracked_messages()
+        page_size, page_count, freelist = await run_db(database_pages)
+
+        if dry_run:
+            rows, oldest, newest, payload = await run_db(retention_preview, cutoff)
+            report = f"🧪 Retention dry run - older than {days} days (before {boundary_day})\n\n"
+            if rows:
+                report += (f"Would archive {rows} messages ({format_epoch(oldest, '%Y-%m-%d')} → "
+                           f"{format_epoch(newest, '%Y-%m-%d')}), ~{format_bytes(payload)} of message data\n")
+            else:
+                report += "Nothing to archive.\n"
+            report += (f"Database: {format_bytes(page_count * page_size)}, "
+                       f"{format_bytes(freelist * page_size)} already free and reclaimable")
+            if not await run_db(incremental_vacuum_enabled):
+                report += "\nThe first real run switches the database to incremental auto-vacuum with a one-time full VACUUM."
+            return report
+
+        started = time.monotonic()
+        await run_db(start_retention, boundary_day)
+        archive = MessageArchive(os.path.join(
+            ARCHIVE_DIR, f"messages_before_{boundary_day}_{get_current_time().strftime('%Y%m%d_%H%M%S')}.jsonl.gz"
+        ))
+        archived = 0
+        try:
+            while True:
+                moved = await run_db(archive_message_chunk, archive, cutoff, RETENTION_CHUNK_ROWS)
+                archived += moved
+                if moved < RETENTION_CHUNK_ROWS:
+                    break
+        finally:
+            await run_blocking(archive.close)
+        if archived:
+            track_pages.clear()
+
+        # The one-time conversion VACUUM already compacts the whole file
+        converted = await run_db(enable_incremental_vacuum)
+        free_pages = None
+        while not converted:
+            remaining = await run_db(incremental_vacuum, RETENTION_VACUUM_PAGES)
+            # Done when the freelist is empty or stops shrinking (auto_vacuum not incremental,
+            # or other writers freeing pages as fast as they are handed back)
+            if not remaining or (free_pages is not None and remaining >= free_pages):
+                break
+            free_pages = remaining
+        await run_db(checkpoint_wal)
+        _, page_count_after, _ = await run_db(database_pages)
+
+        report = f"🗄 Retention - older than {days} days (before {boundary_day})\n\n"
+        if archived:
+            report += f"Archived {archived} messages to {archive.path} ({format_bytes(archive.size())})\n"
+        else:
+            report += "Nothing to archive.\n"
+        report += (f"Database: {format_bytes(page_count * page_size)} → {format_bytes(page_count_after * page_size)}, "
+                   f"reclaimed {format_bytes(max(0, page_count - page_count_after) * page_size)} "
+                   f"in {time.monotonic() - started:.1f}s")
+        if converted:
+            report += "\nSwitched the database to incremental auto-vacuum (one-time full VACUUM)."
+        return report
+
+# Background task: apply RETENTION_DAYS every RETENTION_INTERVAL_HOURS; reports go out as admin events
+async def retention_job(bot):
+    await asyncio.sleep(RETENTION_STARTUP_DELAY)
+    while True:
+        try:
+            await send_admin_event(bot, await run_retention(RETENTION_DAYS))
+        except Exception as e:
+            print(f"Retention error: {e}")
+            await send_admin_event(bot, f"❌ Retention run failed: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL_HOURS * 3600)
+
+async def send_retention_report(bot, chat_id, days, dry_run):
+    try:
+        report = await run_retention(days, dry_run)
+    except Exception as e:
+        report = f"❌ Retention failed: {e}"
+    await bot.send_message(chat_id=chat_id, text=report)
+
+# Retention command (admin only): /retention [days] [dryrun] - runs a pass now, in the background
+async def retention_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ This command is for admin only!")
+        return
+
+    args = context.args or []
+    dry_run = 'dryrun' in args
+    numbers = [arg for arg in args if arg != 'dryrun']
+    if any(not arg.isdigit() or int(arg) < 1 for arg in numbers) or len(numbers) > 1:
+        await update.message.reply_text("❌ Usage: /retention [days] [dryrun]")
+        return
+    days = int(numbers[0]) if numbers else RETENTION_DAYS
+    if not days:
+        await update.message.reply_text(
+            "🗄 Retention is off (RETENTION_DAYS=0).\n\n"
+            "Usage: /retention <days> [dryrun] - archive messages older than <days> now"
+        )
+        return
+    if retention_lock().locked():
+        await update.message.reply_text("⏳ A retention run is already in progress.")
+        return
+
+    await update.message.reply_text(f"⏳ {'Dry run' if dry_run else 'Retention'} for messages older than {days} days started...")
+    context.application.create_task(
+        send_retention_report(context.bot, update.effective_chat.id, days, dry_run),
+        update=update
+    )
+
+# Stats command (admin only): /stats [days], /stats rebuild - answered from the rollup tables
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ This command is for admin only!")
+        return
+
+    args = context.args or []
+    if args and args[0] == 'rebuild':
+        await update.message.reply_text("🔄 Rebuilding stats from raw rows...")
+        await flush_tracked_messages()
+        await user_activity.flush()
+        days_rebuilt = await run_db(rebuild_stats)
+        await update.message.reply_text(f"✅ Stats rebuilt: {days_rebuilt} days. AI usage is kept as recorded.")
+        return
 
-    conn = sqlite3.connect('ngl_bot.db')
-    cursor = conn.cursor()
-
-    # Get sent messages
-    cursor.execute('''
-        SELECT ngl_link, message_text, status, timestamp 
-        FROM messages 
-        WHERE user_id = ? 
-        ORDER BY timestamp DESC 
-        LIMIT 10
-    ''', (user_id,))
-
-    sent_messages = cursor.fetchall()
-    conn.close()
-
-    track_text = f"🕐 Current Time: {current_time.strftime('%Y/%m/%d-%I:%M-%p')}\n\n"
-
-    # Show sent messages
-    if sent_messages:
-        track_text += "📊 Recent Sent Messages:\n\n"
-        for i, (link, text, status, timestamp) in enumerate(sent_messages):
-            status_icon = "✅" if status == "success" else "❌"
-            time_str = datetime.fromisoformat(timestamp).astimezone(TIMEZONE).strftime("%m/%d %H:%M")
-            track_text += f"{status_icon} {time_str}\n"
-            track_text += f"Link: {link}\n"
-            track_text += f"Message: {text[:50]}...\n\n"
+    days = int(args[0]) if args and args[0].isdigit() and int(args[0]) > 0 else 7
+    await user_activity.flush()
+    recent, totals, ai_recent = await run_db(get_stats, days)
+
+    stats_text = f"📈 Stats - last {days} days\n\n"
+    if recent:
+        stats_text += "Day: sends (✅/❌) · ⛔ capped · new · active\n"
+        for day, sends, success, failed, capped, new_users, active_users in recent:
+            stats_text += f"{day}: {sends} ({success}/{failed}) · ⛔{capped} · {new_users} · {active_users}\n"
+        period_sends = sum(row[1] for row in recent)
+        period_success = sum(row[2] for row in recent)
+        success_rate = f"{period_success / period_sends:.1%}" if period_sends else "n/a"
+        stats_text += f"\nPeriod: {period_sends} sends, {success_rate} success, {sum(row[5] for row in recent)} new users\n"
     else:
-        track_text += "📭 No messages sent yet. Use /send to start sending messages."
+        stats_text += "No activity in this period.\n"
+
+    if ai_recent:
+        stats_text += "\n🤖 AI messages by language:\n"
+        stats_text += "\n".join(f"• {LANGUAGES.get(language, language)}: {count}" for language, count in ai_recent) + "\n"
+
+    day_count, sends, success, failed, capped, new_users = totals
+    if day_count:
+        success_rate = f"{success / sends:.1%}" if sends else "n/a"
+        stats_text += (f"\n📊 All time ({day_count} days): {sends} sends, {success_rate} success, "
+                       f"{failed} failed, {capped} capped, {new_users} users joined")
+
+    await update.message.reply_text(stats_text)
 
-    await update.message.reply_text(track_text)
+# Admin digest command (admin only): /digest, /digest <seconds>, /digest off, /digest now
+async def digest_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ This command is for admin only!")
+        return
+
+    args = context.args or []
+    if args and args[0] == 'now':
+        await admin_digest.flush(context.bot)
+        await update.message.reply_text("✅ Digest flushed.")
+        return
+    if args:
+        if args[0] == 'off':
+            seconds = 0
+        elif args[0].isdigit():
+            seconds = int(args[0])
+        else:
+            await update.message.reply_text("Usage: /digest [seconds|off|now]")
+            return
+        if seconds == 0:
+            await admin_digest.flush(context.bot)
+        admin_digest.set_interval(seconds)
+        await run_db(set_meta, 'admin_digest_interval', str(seconds))
+
+    interval = f"every {admin_digest.interval}s or {admin_digest.max_events} events" if admin_digest.interval > 0 else "off (events are sent immediately)"
+    await update.message.reply_text(
+        f"📬 Admin digest: {interval}\n"
+        f"Pending events: {admin_digest.pending()}\n\n"
+        "Usage: /digest <seconds> to change the interval, /digest off to disable, /digest now to send pending events"
+    )
+
+error_log = logging.getLogger('ngl_bot.errors')
+
+def setup_error_log():
+    handler = RotatingFileHandler(ERROR_LOG_PATH, maxBytes=ERROR_LOG_MAX_BYTES, backupCount=ERROR_LOG_BACKUPS, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    error_log.addHandler(handler)
+    error_log.setLevel(logging.ERROR)
+    error_log.propagate = False
+
+# Exception type + innermost frame in this file (or the innermost frame at all)
+def error_fingerprint(error):
+    frames = traceback.extract_tb(error.__traceback__) if error.__traceback__ else []
+    own_frames = [frame for frame in frames if frame.filename == __file__]
+    if not (own_frames or frames):
+        return type(error).__name__
+    frame = (own_frames or frames)[-1]
+    return f"{type(error).__name__} at {os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}"
+
+# Per-fingerprint error counters: the first occurrence alerts right away, repeats within
+# ERROR_ALERT_INTERVAL are only counted and reported in the periodic summary
+class ErrorTracker:
+    def __init__(self, alert_interval, max_fingerprints):
+        self.alert_interval = alert_interval
+        self.max_fingerprints = max_fingerprints
+        self._errors = OrderedDict()  # fingerprint -> stats, least recently seen first
+        self.total = 0
+        self.alerts = 0
+
+    # Count an error; returns True if the admin should be alerted now
+    def record(self, fingerprint, message):
+        now = time.monotonic()
+        seen_at = get_current_time()
+        self.total += 1
+        stats = self._errors.pop(fingerprint, None)
+        if stats is None:
+            stats = {'count': 0, 'unreported': 0, 'first_seen': seen_at, 'last_alert': None}
+            if len(self._errors) >= self.max_fingerprints:
+                self._errors.popitem(last=False)
+        self._errors[fingerprint] = stats
+        stats['count'] += 1
+        stats['last_seen'] = seen_at
+        stats['message'] = message
+
+        if stats['last_alert'] is None or now - stats['last_alert'] >= self.alert_interval:
+            stats['last_alert'] = now
+            self.alerts += 1
+            return True
+        stats['unreported'] += 1
+        return False
+
+    def fingerprints(self):
+        return len(self._errors)
+
+    # Summary of errors suppressed since the last summary (None if there were none)
+    def summary(self):
+        lines = []
+        for fingerprint, stats in self._errors.items():
+            if not stats['unreported']:
+                continue
+            lines.append(
+                f"• {fingerprint}\n"
+                f"  {stats['unreported']} suppressed, {stats['count']} total - "
+                f"first {stats['first_seen'].strftime('%m/%d %H:%M:%S')}, last {stats['last_seen'].strftime('%m/%d %H:%M:%S')}\n"
+                f"  {stats['message'][:200]}"
+            )
+            stats['unreported'] = 0
+        if not lines:
+            return None
+        text = "🧯 Error summary (repeats suppressed since the last alert):\n\n" + "\n".join(lines)
+        return text[:TELEGRAM_MESSAGE_LIMIT]
+
+    async def run(self, bot, interval):
+        while True:
+            await asyncio.sleep(interval)
+            text = self.summary()
+            if text:
+                try:
+                    await bot.send_message(chat_id=ADMIN_ID, text=text)
+                except Exception as e:
+                    print(f"Error summary failed: {e}")
+
+error_tracker = ErrorTracker(ERROR_ALERT_INTERVAL, ERROR_MAX_FINGERPRINTS)
 
 # Error handler
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        error_msg = f"❌ Bot Error:\n{context.error}"
-        user_id = update.effective_user.id if update and update.effective_user else "Unknown"
-        await notify_admin(context, error_msg, user_id)
+        error = context.error
+        fingerprint = error_fingerprint(error)
+        error_log.error(
+            "%s\n%s", fingerprint,
+            ''.join(traceback.format_exception(type(error), error, error.__traceback__)).rstrip()
+        )
+        if error_tracker.record(fingerprint, str(error)):
+            user_id = update.effective_user.id if isinstance(update, Update) and update.effective_user else "Unknown"
+            error_msg = f"❌ Bot Error:\n{error}\n\n👤 User: {user_id}\n🔎 {fingerprint}\nRepeats in the next {ERROR_ALERT_INTERVAL}s are summarized instead. Traceback: {ERROR_LOG_PATH}"
+            # Sent regardless of who hit the error - the fingerprint is already marked as alerted
+            await send_admin_event(context.bot, error_msg, urgent=True)
     except Exception as e:
         print(f"Error handler failed: {e}")
 
+# Background tasks started with the bot
+_background_tasks = []
+
+async def on_startup(application: Application):
+    membership_cache.load(await run_db(load_memberships))
+    await detect_event_chats(application.bot)
+    _background_tasks.append(asyncio.create_task(backfill_memberships(application.bot)))
+    link_cap.load(await run_db(get_recent_submissions, epoch_seconds(seconds_ago=LINK_CAP_WINDOW_SECONDS)))
+    digest_interval = await run_db(get_meta, 'admin_digest_interval')
+    if digest_interval is not None:
+        admin_digest.set_interval(int(digest_interval))
+    await broadcast_engine.resume(application.bot)
+    _background_tasks.append(asyncio.create_task(message_log_writer()))
+    _background_tasks.append(asyncio.create_task(rate_limit_writer()))
+    _background_tasks.append(asyncio.create_task(user_activity.run(ACTIVITY_FLUSH_SECONDS)))
+    _background_tasks.append(asyncio.create_task(admin_digest.run(application.bot)))
+    _background_tasks.append(asyncio.create_task(error_tracker.run(application.bot, ERROR_SUMMARY_INTERVAL)))
+    if AI_MODE != 'local':
+        _background_tasks.append(asyncio.create_task(ai_message_pool.run(AI_POOL_REFILL_INTERVAL)))
+    if RETENTION_DAYS > 0:
+        _background_tasks.append(asyncio.create_task(retention_job(application.bot)))
+
+# Stop the broadcast, cancel running send batches and send what is left in the admin digest
+# while the bot can still make requests
+async def on_stop(application: Application):
+    await broadcast_engine.stop()
+    await cancel_send_batches()
+    await admin_digest.flush(application.bot)
+
+# Stop background tasks, flush buffered writes and release shared resources
+async def on_shutdown(application: Application):
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    await flush_tracked_messages()
+    await rate_limiter.flush()
+    await user_activity.flush()
+    await gemini_client.close()
+    close_db()
+
 def main():
     init_db()
+    setup_error_log()
 
     # Start Flask server in a separate thread
     flask_thread = threading.Thread(target=run_flask, daemon=True)
     flask_thread.start()
 
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = Application.builder().token(BOT_TOKEN).post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown).build()
 
+    application.add_handler(TypeHandler(Update, record_activity), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("send", send_command))
     application.add_handler(CommandHandler("track", track_command))
     application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("metrics", metrics_command))
+    application.add_handler(CommandHandler("digest", digest_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("retention", retention_command))
+    application.add_handler(CommandHandler("pruned", pruned_command))
     application.add_handler(CallbackQueryHandler(handle_callback))
+    application.add_handler(ChatMemberHandler(handle_chat_member, ChatMemberHandler.CHAT_MEMBER))
     
     # Add handler for broadcast content (photos, forwarded messages, etc.)
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
@@ -966,7 +3780,8 @@ def main():
     application.add_error_handler(error_handler)
 
     print("Bot is running...")
-    application.run_polling()
+    # chat_member updates are only delivered when explicitly requested
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file